@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""Measure pyqver3 throughput and compare results between commits.
+
+Usage: benchmark.py [-n repeat] [-o results.json] [directory ...]
+       benchmark.py --compare old.json new.json [--threshold fraction]
+
+The corpus is the given directories (default: the standard library of the
+running interpreter) plus a set of synthetic worst cases. For each part of
+the corpus the time spent reading, parsing, walking (get_versions on the
+parsed tree) and reporting (the -l format) is measured separately; the best
+of repeat passes is kept. Files that do not parse are listed and not
+counted. Each part runs in a child process, whose peak RSS is recorded.
+Results are printed and, with -o, saved as JSON.
+
+--compare reads two saved results and flags every stage that got slower,
+and every peak RSS that grew, by more than the threshold (default 0.1, i.e.
+10%), and every part with more files that do not parse, exiting with
+status 1 if there is any.
+"""
+
+import ast
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import sysconfig
+import time
+import traceback
+
+import pyqver3
+
+Stages = ["read", "parse", "walk", "report"]
+
+def synthetic_cases():
+    """Return the synthetic worst cases as a dict of name: [(name, source)]."""
+    cases = {}
+    # blocks nested close to the parser's indentation limit, and
+    # expressions nested close to its parenthesis limit
+    depth = 90
+    src = "".join(" " * i + "if x:\n" for i in range(depth)) + " " * depth + "os.sync()\n"
+    src += "y = " + "(" * 150 + "lzma.open()" + ")" * 150 + "\n"
+    cases["deep-nesting"] = [("deep-nesting.py", src)]
+    # long chains of operators and attributes make deep trees
+    src = "x = " + " + ".join(["a"] * 2000) + "\n"
+    src += "y = a" + ".b" * 2000 + "()\n"
+    cases["long-chains"] = [("long-chains.py", src)]
+    # the same at depths only generated code reaches, checking that
+    # nothing recurses per level; from Python 3.12 the parser stops well
+    # short of pyqver3.ParseDepth, so the depth is halved until it parses
+    depth = 20000
+    while True:
+        src = "x = " + " + ".join(["a"] * depth) + "\n"
+        src += "y = a" + ".b" * depth + "()\n"
+        src += "z = a" + "[0]" * depth + "\n"
+        src += "w = f" + "()" * depth + "\n"
+        try:
+            pyqver3.parse(src)
+            break
+        except SyntaxError:
+            depth //= 2
+    cases["deep-chains"] = [("deep-chains.py", src)]
+    # a very long file of ordinary code
+    lines = []
+    for i in range(10000):
+        lines.append("def f{0}(a, b=1, *args, **kw):\n    return [x * b for x in args if x > a] + list(kw.items())\n".format(i))
+    cases["long-file"] = [("long-file.py", "".join(lines))]
+    # thousands of findings on distinct lines
+    lines = []
+    for i in range(5000):
+        lines.append("collections.OrderedDict(); os.sync(); x = yield from g{0}\n".format(i))
+    cases["many-findings"] = [("many-findings.py", "def g():\n" + "".join("    " + x for x in lines))]
+    return cases
+
+def run_case(items, repeat):
+    """Time each stage over items, a list of (name, source or None).
+
+    A source of None means the name is a file to read.
+    """
+    best = dict((s, None) for s in Stages)
+    nodes = 0
+    nbytes = 0
+    errors = []
+    unparsed = []
+    for r in range(repeat):
+        times = dict((s, 0.0) for s in Stages)
+        files = 0
+        nodes = 0
+        nbytes = 0
+        errors = []
+        unparsed = []
+        for fn, source in items:
+            t0 = time.perf_counter()
+            if source is None:
+                f = open(fn, "rb")
+                source = f.read()
+                f.close()
+            t1 = time.perf_counter()
+            try:
+                tree = pyqver3.parse(source, fn)
+            except (SyntaxError, ValueError):
+                unparsed.append(fn)
+                continue
+            t2 = time.perf_counter()
+            try:
+                ver = pyqver3.get_versions(tree)
+            except RecursionError as x:
+                errors.append("{0}: {1}".format(fn, x))
+                continue
+            t3 = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                pyqver3.report(fn, ver)
+            t4 = time.perf_counter()
+            times["read"] += t1 - t0
+            times["parse"] += t2 - t1
+            times["walk"] += t3 - t2
+            times["report"] += t4 - t3
+            files += 1
+            nodes += sum(1 for n in ast.walk(tree))
+            nbytes += len(source)
+        for s in Stages:
+            if best[s] is None or times[s] < best[s]:
+                best[s] = times[s]
+    result = {"files": files, "bytes": nbytes, "nodes": nodes}
+    for s in Stages:
+        result[s + "_s"] = best[s]
+    total = sum(best.values())
+    result["total_s"] = total
+    result["files_per_s"] = files / total if total else None
+    result["nodes_per_s"] = nodes / best["walk"] if best["walk"] else None
+    if errors:
+        result["errors"] = errors
+    if unparsed:
+        result["unparsed"] = unparsed
+    return result
+
+def run_case_apart(items, repeat):
+    """Return run_case(items, repeat) run in a child process, with the peak
+    RSS of the child as peak_rss_kb, so that no case counts the memory of
+    the cases before it.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        status = 1
+        try:
+            result = run_case(items, repeat)
+            result["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            f = os.fdopen(w, "w")
+            json.dump(result, f)
+            f.close()
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(w)
+    f = os.fdopen(r)
+    data = f.read()
+    f.close()
+    pid, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError("benchmark case failed")
+    return json.loads(data)
+
+def benchmark(paths, repeat):
+    if not paths:
+        paths = [sysconfig.get_paths()["stdlib"]]
+        pyqver3.Exclude = ["site-packages"]
+    corpus = {"files": [(fn, None) for fn in pyqver3.iter_files(paths)]}
+    corpus.update(synthetic_cases())
+    pyqver3.Lint = True
+    results = {}
+    for name, items in corpus.items():
+        results[name] = run_case_apart(items, repeat)
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "paths": paths,
+        "repeat": repeat,
+        "peak_rss_kb": max(r["peak_rss_kb"] for r in results.values()),
+        "cases": results,
+    }
+
+def print_results(data):
+    print("Python {0}, peak RSS {1} kB".format(data["python"], data["peak_rss_kb"]))
+    print("{0:<14} {1:>6} {2:>9} {3:>8} {4:>8} {5:>8} {6:>8} {7:>9} {8:>10} {9:>9}".format(
+        "case", "files", "nodes", "read", "parse", "walk", "report", "files/s", "nodes/s", "rss kB"))
+    for name, r in sorted(data["cases"].items()):
+        print("{0:<14} {1:>6} {2:>9} {3:>8.3f} {4:>8.3f} {5:>8.3f} {6:>8.3f} {7:>9.1f} {8:>10.0f} {9:>9}".format(
+            name, r["files"], r["nodes"], r["read_s"], r["parse_s"], r["walk_s"], r["report_s"],
+            r["files_per_s"] or 0, r["nodes_per_s"] or 0, r.get("peak_rss_kb", "")))
+        for e in r.get("errors", []):
+            print("    error: {0}".format(e))
+        if r.get("unparsed"):
+            print("    {0} files do not parse".format(len(r["unparsed"])))
+
+def compare(old, new, threshold):
+    """Print the change in every stage and peak RSS between two results, and
+    return the number of regressions: stages that got slower and peaks that
+    grew by more than threshold, and new errors or files that do not parse.
+    """
+    if old["python"] != new["python"]:
+        print("warning: comparing Python {0} with Python {1}".format(old["python"], new["python"]))
+    slower = 0
+    for name in sorted(set(old["cases"]) & set(new["cases"])):
+        o = old["cases"][name]
+        n = new["cases"][name]
+        for s in Stages + ["total"]:
+            a = o[s + "_s"]
+            b = n[s + "_s"]
+            if not a or not b:
+                continue
+            change = b / a - 1
+            flag = ""
+            # tiny stages are mostly noise
+            if change > threshold and b - a > 0.001:
+                flag = "  SLOWER"
+                slower += 1
+            print("{0:<14} {1:<7} {2:>9.4f} {3:>9.4f} {4:>+7.1%}{5}".format(name, s, a, b, change, flag))
+        a = o.get("peak_rss_kb")
+        b = n.get("peak_rss_kb")
+        if a and b:
+            change = b / a - 1
+            flag = ""
+            # a few pages either way are noise
+            if change > threshold and b - a > 1024:
+                flag = "  LARGER"
+                slower += 1
+            print("{0:<14} {1:<7} {2:>9} {3:>9} {4:>+7.1%}{5}".format(name, "rss kB", a, b, change, flag))
+        if len(o.get("errors", [])) < len(n.get("errors", [])):
+            print("{0:<14} new errors: {1}".format(name, len(n["errors"]) - len(o.get("errors", []))))
+            slower += 1
+        if len(o.get("unparsed", [])) < len(n.get("unparsed", [])):
+            print("{0:<14} more files do not parse: {1}".format(name, len(n["unparsed"]) - len(o.get("unparsed", []))))
+            slower += 1
+    return slower
+
+def main(argv):
+    repeat = 3
+    output = None
+    threshold = 0.1
+    comparing = False
+    paths = []
+    i = 1
+    while i < len(argv):
+        a = argv[i]
+        if a == "-n":
+            i += 1
+            repeat = int(argv[i])
+        elif a == "-o":
+            i += 1
+            output = argv[i]
+        elif a == "--compare":
+            comparing = True
+        elif a == "--threshold":
+            i += 1
+            threshold = float(argv[i])
+        else:
+            paths.append(a)
+        i += 1
+    if comparing:
+        if len(paths) != 2:
+            print(__doc__, file=sys.stderr)
+            return 1
+        f = open(paths[0])
+        old = json.load(f)
+        f.close()
+        f = open(paths[1])
+        new = json.load(f)
+        f.close()
+        return 1 if compare(old, new, threshold) else 0
+    data = benchmark(paths, repeat)
+    print_results(data)
+    if output is not None:
+        f = open(output, "w")
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
 import compiler
+import fnmatch
+import os
 import platform
 import sys
 
@@ -120,36 +122,56 @@ Identifiers = {
     "True":         (2, 2),
 }
 
-def uniq(a):
-    if len(a) == 0:
-        return []
-    else:
-        return [a[0]] + uniq([x for x in a if x != a[0]])
-
 class NodeChecker(object):
     def __init__(self):
         self.vers = dict()
         self.vers[(2,0)] = []
+        # (version, lineno, message) of every finding already recorded
+        self.seen = {}
     def add(self, node, ver, msg):
+        # findings are deduplicated here, keeping the first occurrence, so
+        # reporting never has to
+        key = (ver, node.lineno, msg)
+        if key in self.seen:
+            return
+        self.seen[key] = 1
         if ver not in self.vers:
             self.vers[ver] = []
         self.vers[ver].append((node.lineno, msg))
+    def walk(self, tree):
+        """Check tree and everything under it, in the same order as
+        compiler.walk, but with a stack of the nodes still to check instead
+        of recursion, so that deeply nested trees such as long chains of
+        operators in generated code can be checked.
+        """
+        stack = self.stack = [tree]
+        pop = stack.pop
+        methods = {}
+        while stack:
+            node = pop()
+            try:
+                method = methods[node.__class__]
+            except KeyError:
+                method = getattr(self, "visit" + node.__class__.__name__, self.default)
+                methods[node.__class__] = method
+            method(node)
+        return self
     def default(self, node):
-        for child in node.getChildNodes():
-            self.visit(child)
+        # last child first, so that the first one is checked next
+        self.stack.extend(node.getChildNodes()[::-1])
     def visitCallFunc(self, node):
-        def rollup(n):
-            if isinstance(n, compiler.ast.Name):
-                return n.name
-            elif isinstance(n, compiler.ast.Getattr):
-                r = rollup(n.expr)
-                if r:
-                    return r + "." + n.attrname
-        name = rollup(node.node)
-        if name:
+        n = node.node
+        parts = []
+        while isinstance(n, compiler.ast.Getattr):
+            parts.append(n.attrname)
+            n = n.expr
+        if isinstance(n, compiler.ast.Name):
+            parts.append(n.name)
+            parts.reverse()
+            name = ".".join(parts)
             v = Functions.get(name)
             if v is not None:
-                self.add(node, v, name)
+                self.add(node, v, intern(name))
         self.default(node)
     def visitClass(self, node):
         if node.bases:
@@ -224,14 +246,31 @@ class NodeChecker(object):
 def get_versions(source):
     """Return information about the Python versions required for specific features.
 
+    The source may be a string or an already parsed compiler.ast tree.
+
     The return value is a dictionary with keys as a version number as a tuple
     (for example Python 2.6 is (2,6)) and the value are a list of features that
     require the indicated Python version.
     """
-    tree = compiler.parse(source)
-    checker = compiler.walk(tree, NodeChecker())
+    if isinstance(source, compiler.ast.Node):
+        tree = source
+    else:
+        tree = compiler.parse(source)
+    checker = NodeChecker().walk(tree)
     return checker.vers
 
+def get_file_versions(filename):
+    """Like get_versions, for the contents of the named file.
+
+    Raises SyntaxError if the file cannot be compiled.
+    """
+    f = open(filename)
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    return get_versions(source)
+
 def v27(source):
     if sys.version_info >= (2, 7):
         return qver(source)
@@ -242,6 +281,8 @@ def v27(source):
 def qver(source):
     """Return the minimum Python version required to run a particular bit of code.
 
+    The source may be anything accepted by get_versions.
+
     >>> qver('print "hello world"')
     (2, 0)
     >>> qver('class test(object): pass')
@@ -298,6 +339,10 @@ def qver(source):
     (2, 4)
     >>> qver('@decorator\\nclass test:\\n pass')
     (2, 6)
+    >>> qver(compiler.parse('import hashlib'))
+    (2, 5)
+    >>> qver('x = ' + ' + '.join(['a'] * 20000) + ' + sum(a.b' + '.c' * 20000 + ')')
+    (2, 3)
 
     #>>> qver('0o0')
     #(2, 6)
@@ -306,61 +351,165 @@ def qver(source):
     """
     return max(get_versions(source).keys())
 
+def matches(path, patterns):
+    name = os.path.basename(path)
+    for x in patterns:
+        if fnmatch.fnmatch(name, x) or fnmatch.fnmatch(path, x):
+            return True
+    return False
+
+def iter_paths(paths):
+    for p in paths:
+        yield p
+    for ff in FilesFrom:
+        if ff == "-":
+            f = sys.stdin
+        else:
+            f = open(ff)
+        for line in f:
+            line = line.rstrip("\r\n")
+            if line:
+                yield line
+        if f is not sys.stdin:
+            f.close()
+
+def iter_files(paths):
+    """Generate the names of the files to analyze, lazily.
+
+    Directories are walked recursively in sorted order, yielding files that
+    match one of the Include patterns and pruning anything that matches an
+    Exclude pattern. Other paths are yielded as given. Paths listed in the
+    FilesFrom files (one per line, "-" for stdin) are handled the same way
+    after the command line paths.
+    """
+    for p in iter_paths(paths):
+        if not os.path.isdir(p):
+            yield p
+            continue
+        for dirpath, dirnames, filenames in os.walk(p):
+            keep = [d for d in dirnames if not matches(os.path.join(dirpath, d), Exclude)]
+            keep.sort()
+            dirnames[:] = keep
+            filenames.sort()
+            for fn in filenames:
+                path = os.path.join(dirpath, fn)
+                if matches(fn, Include) and not matches(path, Exclude):
+                    yield path
+
 Verbose = False
 MinVersion = (2, 3)
 Lint = False
+Include = ["*.py"]
+Exclude = []
+FilesFrom = []
+
+# the options main sets only when given, restored at the start of each call
+OptionDefaults = dict((k, globals()[k]) for k in ["Verbose", "MinVersion", "Lint"])
 
-files = []
-i = 1
-while i < len(sys.argv):
-    a = sys.argv[i]
-    if a == "--test":
-        import doctest
-        doctest.testmod()
-        sys.exit(0)
-    if a == "-v" or a == "--verbose":
-        Verbose = True
-    elif a == "-l" or a == "--lint":
-        Lint = True
-    elif a == "-m" or a == "--min-version":
+def main(argv=None):
+    """Run the command line interface and return the exit status.
+
+    Options given to an earlier call do not carry over to the next one:
+
+    >>> import tempfile
+    >>> cwd = os.getcwd()
+    >>> os.chdir(tempfile.mkdtemp())
+    >>> f = open("a.py", "w")
+    >>> f.write("import platform\\n")
+    >>> f.close()
+    >>> main(["pyqver2.py", "-l", "a.py"])
+    a.py:1: 2.3 platform
+    0
+    >>> main(["pyqver2.py", "a.py"])  # doctest: +NORMALIZE_WHITESPACE
+    2.3 a.py
+    0
+    >>> os.chdir(cwd)
+    """
+    global Verbose, MinVersion, Lint, Include, Exclude, FilesFrom
+    for k, v in OptionDefaults.items():
+        globals()[k] = v
+    if argv is None:
+        argv = sys.argv
+    include = []
+    exclude = []
+    files_from = []
+    files = []
+    i = 1
+    while i < len(argv):
+        a = argv[i]
+        if a == "--test":
+            import doctest
+            doctest.testmod()
+            return 0
+        if a == "-v" or a == "--verbose":
+            Verbose = True
+        elif a == "-l" or a == "--lint":
+            Lint = True
+        elif a == "-m" or a == "--min-version":
+            i += 1
+            MinVersion = tuple(map(int, argv[i].split(".")))
+        elif a == "--include":
+            i += 1
+            include.append(argv[i])
+        elif a == "--exclude":
+            i += 1
+            exclude.append(argv[i])
+        elif a == "--files-from":
+            i += 1
+            files_from.append(argv[i])
+        else:
+            files.append(a)
         i += 1
-        MinVersion = tuple(map(int, sys.argv[i].split(".")))
-    else:
-        files.append(a)
-    i += 1
 
-if not files:
-    print >>sys.stderr, """Usage: %s [options] source ...
+    if not files and not files_from:
+        print >>sys.stderr, """Usage: %s [options] source ...
 
     Report minimum Python version required to run given source files.
+    Directories are searched recursively for files matching --include.
 
+    --exclude pattern
+        skip files and directories matching pattern (may be repeated)
+    --files-from file
+        also read source paths from file, one per line ("-" for stdin)
+    --include pattern
+        analyze files in directories matching pattern (default *.py,
+        may be repeated)
     -m x.y or --min-version x.y (default 2.3)
         report version triggers at or above version x.y in verbose mode
     -v or --verbose
         print more detailed report of version triggers for each version
-""" % sys.argv[0]
-    sys.exit(1)
+""" % argv[0]
+        return 1
 
-for fn in files:
-    try:
-        f = open(fn)
-        source = f.read()
-        f.close()
-        ver = get_versions(source)
-        if Verbose:
-            print fn
-            for v in sorted([k for k in ver.keys() if k >= MinVersion], reverse=True):
-                reasons = [x for x in uniq(ver[v]) if x]
-                if reasons:
-                    # each reason is (lineno, message)
-                    print "\t%s\t%s" % (".".join(map(str, v)), ", ".join([x[1] for x in reasons]))
-        elif Lint:
-            for v in sorted([k for k in ver.keys() if k >= MinVersion], reverse=True):
-                reasons = [x for x in uniq(ver[v]) if x]
-                for r in reasons:
-                    # each reason is (lineno, message)
-                    print "%s:%s: %s %s" % (fn, r[0], ".".join(map(str, v)), r[1])
-        else:
-            print "%s\t%s" % (".".join(map(str, max(ver.keys()))), fn)
-    except SyntaxError, x:
-        print "%s: syntax error compiling with Python %s: %s" % (fn, platform.python_version(), x)
+    Include = include or ["*.py"]
+    Exclude = exclude
+    FilesFrom = files_from
+
+    for fn in iter_files(files):
+        try:
+            f = open(fn)
+            source = f.read()
+            f.close()
+            ver = get_versions(source)
+            if Verbose:
+                print fn
+                for v in sorted([k for k in ver.keys() if k >= MinVersion], reverse=True):
+                    reasons = [x for x in ver[v] if x]
+                    if reasons:
+                        # each reason is (lineno, message)
+                        print "\t%s\t%s" % (".".join(map(str, v)), ", ".join([x[1] for x in reasons]))
+            elif Lint:
+                for v in sorted([k for k in ver.keys() if k >= MinVersion], reverse=True):
+                    reasons = [x for x in ver[v] if x]
+                    for r in reasons:
+                        # each reason is (lineno, message)
+                        print "%s:%s: %s %s" % (fn, r[0], ".".join(map(str, v)), r[1])
+            else:
+                print "%s\t%s" % (".".join(map(str, max(ver.keys()))), fn)
+        except SyntaxError, x:
+            print "%s: syntax error compiling with Python %s: %s" % (fn, platform.python_version(), x)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
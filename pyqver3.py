@@ -1,198 +1,1120 @@
 #!/usr/bin/env python3
 
+import array
 import ast
+import bisect
+import collections
+import contextlib
+import fnmatch
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import marshal
+import os
 import platform
+import re
+import select
+import signal
+import socket
+import stat
+import struct
+import subprocess
 import sys
+import tarfile
+import threading
+import time
+import tokenize
+import unicodedata
+import urllib.parse
+import zipfile
+import zlib
 
-StandardModules = {
-    "argparse":         (3, 2),
-    "faulthandler":     (3, 3),
-    "importlib":        (3, 1),
-    "ipaddress":        (3, 3),
-    "lzma":             (3, 3),
-    "tkinter.ttk":      (3, 1),
-    "unittest.mock":    (3, 3),
-    "venv":             (3, 3),
-}
-
-Functions = {
-    "bytearray.maketrans":                      (3, 1),
-    "bytes.maketrans":                          (3, 1),
-    "bz2.open":                                 (3, 3),
-    "collections.Counter":                      (3, 1),
-    "collections.OrderedDict":                  (3, 1),
-    "crypt.mksalt":                             (3, 3),
-    "email.generator.BytesGenerator":           (3, 2),
-    "email.message_from_binary_file":           (3, 2),
-    "email.message_from_bytes":                 (3, 2),
-    "functools.lru_cache":                      (3, 2),
-    "gzip.compress":                            (3, 2),
-    "gzip.decompress":                          (3, 2),
-    "inspect.getclosurevars":                   (3, 3),
-    "inspect.getgeneratorlocals":               (3, 3),
-    "inspect.getgeneratorstate":                (3, 2),
-    "itertools.combinations_with_replacement":  (3, 1),
-    "itertools.compress":                       (3, 1),
-    "logging.config.dictConfig":                (3, 2),
-    "logging.NullHandler":                      (3, 1),
-    "math.erf":                                 (3, 2),
-    "math.erfc":                                (3, 2),
-    "math.expm1":                               (3, 2),
-    "math.gamma":                               (3, 2),
-    "math.isfinite":                            (3, 2),
-    "math.lgamma":                              (3, 2),
-    "math.log2":                                (3, 3),
-    "os.environb":                              (3, 2),
-    "os.fsdecode":                              (3, 2),
-    "os.fsencode":                              (3, 2),
-    "os.fwalk":                                 (3, 3),
-    "os.getenvb":                               (3, 2),
-    "os.get_exec_path":                         (3, 2),
-    "os.getgrouplist":                          (3, 3),
-    "os.getpriority":                           (3, 3),
-    "os.getresgid":                             (3, 2),
-    "os.getresuid":                             (3, 2),
-    "os.get_terminal_size":                     (3, 3),
-    "os.getxattr":                              (3, 3),
-    "os.initgroups":                            (3, 2),
-    "os.listxattr":                             (3, 3),
-    "os.lockf":                                 (3, 3),
-    "os.pipe2":                                 (3, 3),
-    "os.posix_fadvise":                         (3, 3),
-    "os.posix_fallocate":                       (3, 3),
-    "os.pread":                                 (3, 3),
-    "os.pwrite":                                (3, 3),
-    "os.readv":                                 (3, 3),
-    "os.removexattr":                           (3, 3),
-    "os.replace":                               (3, 3),
-    "os.sched_get_priority_max":                (3, 3),
-    "os.sched_get_priority_min":                (3, 3),
-    "os.sched_getaffinity":                     (3, 3),
-    "os.sched_getparam":                        (3, 3),
-    "os.sched_getscheduler":                    (3, 3),
-    "os.sched_rr_get_interval":                 (3, 3),
-    "os.sched_setaffinity":                     (3, 3),
-    "os.sched_setparam":                        (3, 3),
-    "os.sched_setscheduler":                    (3, 3),
-    "os.sched_yield":                           (3, 3),
-    "os.sendfile":                              (3, 3),
-    "os.setpriority":                           (3, 3),
-    "os.setresgid":                             (3, 2),
-    "os.setresuid":                             (3, 2),
-    "os.setxattr":                              (3, 3),
-    "os.sync":                                  (3, 3),
-    "os.truncate":                              (3, 3),
-    "os.waitid":                                (3, 3),
-    "os.writev":                                (3, 3),
-    "shutil.chown":                             (3, 3),
-    "shutil.disk_usage":                        (3, 3),
-    "shutil.get_archive_formats":               (3, 3),
-    "shutil.get_terminal_size":                 (3, 3),
-    "shutil.get_unpack_formats":                (3, 3),
-    "shutil.make_archive":                      (3, 3),
-    "shutil.register_archive_format":           (3, 3),
-    "shutil.register_unpack_format":            (3, 3),
-    "shutil.unpack_archive":                    (3, 3),
-    "shutil.unregister_archive_format":         (3, 3),
-    "shutil.unregister_unpack_format":          (3, 3),
-    "shutil.which":                             (3, 3),
-    "signal.pthread_kill":                      (3, 3),
-    "signal.pthread_sigmask":                   (3, 3),
-    "signal.sigpending":                        (3, 3),
-    "signal.sigtimedwait":                      (3, 3),
-    "signal.sigwait":                           (3, 3),
-    "signal.sigwaitinfo":                       (3, 3),
-    "socket.CMSG_LEN":                          (3, 3),
-    "socket.CMSG_SPACE":                        (3, 3),
-    "socket.fromshare":                         (3, 3),
-    "socket.if_indextoname":                    (3, 3),
-    "socket.if_nameindex":                      (3, 3),
-    "socket.if_nametoindex":                    (3, 3),
-    "socket.sethostname":                       (3, 3),
-    "ssl.match_hostname":                       (3, 2),
-    "ssl.RAND_bytes":                           (3, 3),
-    "ssl.RAND_pseudo_bytes":                    (3, 3),
-    "ssl.SSLContext":                           (3, 2),
-    "ssl.SSLEOFError":                          (3, 3),
-    "ssl.SSLSyscallError":                      (3, 3),
-    "ssl.SSLWantReadError":                     (3, 3),
-    "ssl.SSLWantWriteError":                    (3, 3),
-    "ssl.SSLZeroReturnError":                   (3, 3),
-    "stat.filemode":                            (3, 3),
-    "textwrap.indent":                          (3, 3),
-    "threading.get_ident":                      (3, 3),
-    "time.clock_getres":                        (3, 3),
-    "time.clock_gettime":                       (3, 3),
-    "time.clock_settime":                       (3, 3),
-    "time.get_clock_info":                      (3, 3),
-    "time.monotonic":                           (3, 3),
-    "time.perf_counter":                        (3, 3),
-    "time.process_time":                        (3, 3),
-    "types.new_class":                          (3, 3),
-    "types.prepare_class":                      (3, 3),
-}
-
-def uniq(a):
-    if len(a) == 0:
-        return []
-    else:
-        return [a[0]] + uniq([x for x in a if x != a[0]])
+def compile_functions(functions):
+    """Build the index of dotted names used by NodeChecker.visit_Call.
+
+    The index maps the last component of each name to the largest number of
+    components of a name ending with it, so a call is rejected by a single
+    lookup of its last attribute, and the dotted name is only built for the
+    few calls that may match. A flat dict of short strings is also much
+    quicker to build and load than a tree with a dict per component.
+
+    >>> sorted(compile_functions({"os.sync": (3, 3), "os.path.sync": (3, 4)}).items())
+    [('sync', 3)]
+    """
+    index = {}
+    for name in functions:
+        parts = name.split(".")
+        if index.get(parts[-1], 0) < len(parts):
+            index[parts[-1]] = len(parts)
+    return index
+
+# Bump this when the format of rule files changes.
+RulesFormat = 1
+
+# the rules shipped with pyqver3, which user rule files are layered on
+RulesFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pyqver3_rules.json")
+
+class Rules(object):
+    """A compiled rule database.
+
+    modules maps standard module names to the version that added them,
+    functions maps dotted names of functions and classes to versions,
+    identifiers maps names such as True to versions (only for legacy
+    rules), and function_index is the index of functions built by
+    compile_functions. allowed is the set of names of accepted features,
+    which are not reported. fingerprint is a hash of the rule files and
+    allowed names the database was loaded from.
+    """
+    __slots__ = ("modules", "functions", "identifiers", "function_index", "allowed", "fingerprint")
+    def __init__(self, modules, functions, identifiers, function_index, allowed, fingerprint):
+        self.modules = modules
+        self.functions = functions
+        self.identifiers = identifiers
+        self.function_index = function_index
+        self.allowed = allowed
+        self.fingerprint = fingerprint
+
+def parse_version(s):
+    return tuple(map(int, s.split(".")))
+
+def merge_rules(tables, data, filename, legacy=False):
+    """Add the rules in data, the decoded contents of a rule file, to
+    tables, a dict mapping "modules", "functions" and "identifiers" to dicts
+    of names and versions.
+
+    A rule file is a JSON object with "format" (RulesFormat), "modules" and
+    "functions", each mapping a version such as "3.4" to a list of names,
+    and optionally "remove", a list of names to drop. Names already present
+    are overridden. With legacy, the "legacy" object of the file, with the
+    same keys and "identifiers", is added after the rest: it gives the
+    versions of Python 2 that added each name.
+    """
+    if not isinstance(data, dict) or data.get("format") != RulesFormat:
+        raise ValueError("{0}: not a version {1} rule file".format(filename, RulesFormat))
+    sections = [data]
+    if legacy and "legacy" in data:
+        sections.append(data["legacy"])
+    for section in sections:
+        for name in section.get("remove", []):
+            for table in tables.values():
+                table.pop(name, None)
+        for key, table in tables.items():
+            for ver, names in section.get(key, {}).items():
+                ver = parse_version(ver)
+                for name in names:
+                    table[name] = ver
+
+def allowed_name(name, allow):
+    """Return whether the dotted name is accepted by one of the patterns in
+    allow, which match the name or one of its parents.
+
+    >>> allowed_name("asyncio.run", ["asyncio"])
+    True
+    >>> allowed_name("os.sync", ["os.path", "typing.*"])
+    False
+    """
+    parts = name.split(".")
+    for i in range(1, len(parts) + 1):
+        prefix = ".".join(parts[:i])
+        if any(fnmatch.fnmatchcase(prefix, a) for a in allow):
+            return True
+    return False
+
+def load_rules(paths, cache_dir=None, legacy=False, allow=()):
+    """Load the rule files in paths, each layered on the ones before it,
+    and return a Rules, including their legacy rules if legacy is true.
+
+    Names accepted by allow, as described for allowed_name, are removed
+    from the tables, so they are never looked for. The patterns in allow
+    are also kept as Rules.allowed, for the syntax features, which are
+    named by the message -v prints for them.
+
+    With cache_dir, the compiled rules are kept there keyed by the contents
+    of the files, so later runs skip decoding and compiling them. The cache
+    uses marshal, which loads large tables of names several times faster
+    than json and cannot run code from a tampered file. Raises ValueError
+    for a malformed rule file and IOError if one cannot be read.
+    """
+    allow = sorted(set(allow))
+    h = hashlib.sha1(repr((RulesFormat, sys.version_info[:2], legacy, allow)).encode("utf-8"))
+    contents = []
+    for path in paths:
+        f = open(path, "rb")
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        h.update("{0}\0".format(len(data)).encode("ascii"))
+        h.update(data)
+        contents.append((path, data))
+    fingerprint = h.hexdigest()
+    cached = None
+    if cache_dir is not None:
+        cached = os.path.join(cache_dir, "rules-" + fingerprint + ".marshal")
+        try:
+            f = open(cached, "rb")
+            try:
+                return Rules(*marshal.loads(f.read()))
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+    tables = {"modules": {}, "functions": {}, "identifiers": {}}
+    for path, data in contents:
+        merge_rules(tables, json.loads(data.decode("utf-8")), path, legacy)
+    if allow:
+        for table in tables.values():
+            for name in [name for name in table if allowed_name(name, allow)]:
+                del table[name]
+    rules = Rules(tables["modules"], tables["functions"], tables["identifiers"], compile_functions(tables["functions"]), frozenset(allow), fingerprint)
+    if cached is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = "{0}.{1}.tmp".format(cached, os.getpid())
+            f = open(tmp, "wb")
+            f.write(marshal.dumps((rules.modules, rules.functions, rules.identifiers, rules.function_index, rules.allowed, fingerprint)))
+            f.close()
+            os.replace(tmp, cached)
+        except (IOError, OSError):
+            pass
+    return rules
+
+# the rules in use, and the legacy rules in use
+_rules = [None, None]
+
+def get_rules(legacy=False):
+    """Return the rules in use, or the legacy rules, loading RulesFile and
+    RuleFiles on first use, without the names in Allow.
+    """
+    if _rules[legacy] is None:
+        _rules[legacy] = load_rules([RulesFile] + RuleFiles, CacheDir, legacy, Allow)
+    return _rules[legacy]
+
+def set_rules(rules, legacy=False):
+    """Use rules, a Rules or None to load the rule files again on next use."""
+    global _prefilter
+    _rules[legacy] = rules
+    _prefilter = None
+
+def __getattr__(name):
+    # the rule tables used to be module globals, keep them available
+    # without loading the rules when the module is imported
+    if name == "StandardModules":
+        return get_rules().modules
+    if name == "Functions":
+        return get_rules().functions
+    if name == "FunctionIndex":
+        return get_rules().function_index
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+# visit methods for each node class, per NodeChecker class
+_dispatch_tables = {}
+
+def _skip(checker, node):
+    pass
+
+# the fields of each node class that can hold nodes to check, last first;
+# expression contexts and operators are singletons with nothing to check,
+# the checks that care about them look at them from the parent node
+_child_fields = {}
+
+class StopWalk(Exception):
+    """Raised by NodeChecker.add to abandon the walk once stop_at is reached."""
 
 class NodeChecker(ast.NodeVisitor):
-    def __init__(self):
+    """Collect the versions needed by the features used in a tree.
+
+    The walk does not recurse, so that trees of any depth can be checked,
+    such as the long chains of operators in generated code: visit keeps a
+    stack of the nodes still to check, and generic_visit pushes the children
+    of a node onto it, to be checked in order once the visit method for the
+    node returns. Visit methods check a node before calling generic_visit,
+    so findings come in the same order as from a recursive walk.
+    """
+    # the version every result includes
+    baseline = (3, 0)
+    legacy = False
+    # the lines with a "# pyqver: ignore" comment, as returned by
+    # ignored_lines
+    ignored = None
+    # the nodes still to check in the walk in progress
+    _stack = None
+    def __init__(self, stop_at=None, imports=None, rules=None):
+        if rules is None:
+            rules = get_rules(self.legacy)
+        self.modules = rules.modules
+        self.functions = rules.functions
+        self.identifiers = rules.identifiers
+        self.function_index = rules.function_index
+        self.allowed = rules.allowed
         self.vers = dict()
-        self.vers[(3,0)] = []
+        self.vers[self.baseline] = []
+        # the set of (lineno, message) findings already recorded, for each
+        # version; the tuples are shared with vers
+        self.seen = {}
+        self.stop_at = stop_at
+        self.imports = imports
+        self._dispatch = _dispatch_tables.setdefault(type(self), {})
+    def lookup(self, cls):
+        """Return the function that checks nodes of class cls."""
+        name = "visit_" + cls.__name__
+        method = getattr(type(self), name, None)
+        if method is None or method is getattr(ast.NodeVisitor, name, None):
+            # nothing to check under nodes without fields such as pass;
+            # visit_Constant of ast.NodeVisitor only looks for deprecated
+            # methods
+            method = type(self).generic_visit if cls._fields else _skip
+        return method
+    def visit(self, node):
+        """Check node and everything under it."""
+        outer = self._stack
+        stack = self._stack = [node]
+        # ast.NodeVisitor.visit builds a method name and does a getattr for
+        # every node, look the method up once per node class instead
+        dispatch = self._dispatch
+        try:
+            while stack:
+                node = stack.pop()
+                try:
+                    method = dispatch[node.__class__]
+                except KeyError:
+                    method = dispatch[node.__class__] = self.lookup(node.__class__)
+                method(self, node)
+        finally:
+            self._stack = outer
+    def generic_visit(self, node):
+        # last child first, so that the first one is checked next
+        push = self._stack.append
+        try:
+            fields = _child_fields[node.__class__]
+        except KeyError:
+            fields = _child_fields[node.__class__] = tuple(f for f in reversed(node._fields) if f not in ("ctx", "op", "ops"))
+        for field in fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                for item in reversed(value):
+                    if isinstance(item, ast.AST):
+                        push(item)
+            elif isinstance(value, ast.AST):
+                push(value)
     def add(self, node, ver, msg):
-        if ver not in self.vers:
-            self.vers[ver] = []
-        self.vers[ver].append((node.lineno, msg))
+        """Record that node needs version ver for the feature msg, and
+        return whether it counts: not if it is accepted, ignored or already
+        recorded.
+        """
+        # accepted findings are dropped before anything else, so that they
+        # can not stop the walk either
+        if msg in self.allowed:
+            return False
+        if self.ignored is not None and node.lineno in self.ignored:
+            names = self.ignored[node.lineno]
+            if names is None or msg in names:
+                return False
+        if self.stop_at is not None:
+            # only the versions matter, so don't keep messages for features
+            # below the threshold
+            if ver < self.stop_at:
+                self.vers.setdefault(ver, [])
+                return True
+            self.vers[ver] = [(node.lineno, msg)]
+            raise StopWalk()
+        # findings are deduplicated here, keeping the first occurrence, so
+        # reporting never has to
+        seen = self.seen.get(ver)
+        if seen is None:
+            seen = self.seen[ver] = set()
+            self.vers.setdefault(ver, [])
+        entry = (node.lineno, msg)
+        if entry in seen:
+            return False
+        seen.add(entry)
+        self.vers[ver].append(entry)
+        return True
     def visit_Call(self, node):
-        def rollup(n):
-            if isinstance(n, ast.Name):
-                return n.id
-            elif isinstance(n, ast.Attribute):
-                r = rollup(n.value)
-                if r:
-                    return r + "." + n.attr
-        name = rollup(node.func)
-        if name:
-            v = Functions.get(name)
-            if v is not None:
-                self.add(node, v, name)
+        n = node.func
+        if isinstance(n, ast.Attribute):
+            depth = self.function_index.get(n.attr)
+        elif isinstance(n, ast.Name):
+            depth = self.function_index.get(n.id)
+        else:
+            depth = None
+        if depth is not None:
+            parts = []
+            while isinstance(n, ast.Attribute) and len(parts) < depth:
+                parts.append(n.attr)
+                n = n.value
+            if isinstance(n, ast.Name) and len(parts) < depth:
+                parts.append(n.id)
+                name = ".".join(reversed(parts))
+                v = self.functions.get(name)
+                if v is not None:
+                    # share one copy of the name between all the findings
+                    self.add(node, v, sys.intern(name))
         self.generic_visit(node)
     def visit_Import(self, node):
         for n in node.names:
-            v = StandardModules.get(n.name)
+            if self.imports is not None:
+                self.imports.append((n.name, 0, node.lineno))
+            v = self.modules.get(n.name)
             if v is not None:
-                self.add(node, v, n.name)
+                self.add(node, v, sys.intern(n.name))
         self.generic_visit(node)
     def visit_ImportFrom(self, node):
-        v = StandardModules.get(node.module)
+        if self.imports is not None:
+            # any of the names may be a submodule
+            module = node.module or ""
+            self.imports.append((module, node.level, node.lineno))
+            for n in node.names:
+                if n.name != "*":
+                    self.imports.append((module + "." + n.name if module else n.name, node.level, node.lineno))
+        if node.level or node.module is None:
+            # relative imports never name a standard module
+            return
+        v = self.modules.get(node.module)
         if v is not None:
             self.add(node, v, node.module)
         for n in node.names:
             name = node.module + "." + n.name
-            v = Functions.get(name)
+            v = self.functions.get(name)
             if v is not None:
-                self.add(node, v, name)
+                self.add(node, v, sys.intern(name))
     def visit_Raise(self, node):
-        if isinstance(node.cause, ast.Name) and node.cause.id == "None":
+        if ((isinstance(node.cause, ast.Name) and node.cause.id == "None")
+            or (isinstance(node.cause, getattr(ast, "Constant", ())) and node.cause.value is None)):
             self.add(node, (3,3), "raise ... from None")
+        self.generic_visit(node)
     def visit_YieldFrom(self, node):
         self.add(node, (3,3), "yield from")
 
-def get_versions(source, filename=None):
+class LegacyNodeChecker(NodeChecker):
+    """A NodeChecker that also reports the features pyqver2.py checks for,
+    with the versions of Python 2 that added them, for code that has to run
+    on both. Syntax that Python 2 does not accept at all is reported with
+    the version of Python 3 that added it, 3.0 for the oldest.
+    """
+    baseline = (2, 0)
+    legacy = True
+    def visit_Assign(self, node):
+        for t in node.targets:
+            if isinstance(t, (ast.Tuple, ast.List)) and any(isinstance(x, ast.Starred) for x in t.elts):
+                self.add(node, (3,0), "extended iterable unpacking")
+        self.generic_visit(node)
+    def visit_Attribute(self, node):
+        if (isinstance(node.value, ast.Constant)
+            and isinstance(node.value.value, str)
+            and node.attr == "format"):
+            self.add(node, (2,6), "string literal .format()")
+        self.generic_visit(node)
+    def visit_AsyncFor(self, node):
+        self.add(node, (3,5), "async for")
+        self.generic_visit(node)
+    def visit_AsyncFunctionDef(self, node):
+        self.add(node, (3,5), "async def")
+        self.visit_FunctionDef(node)
+    def visit_AsyncWith(self, node):
+        self.add(node, (3,5), "async with")
+        self.generic_visit(node)
+    def visit_AugAssign(self, node):
+        if isinstance(node.op, ast.FloorDiv):
+            self.add(node, (2,2), "// operator")
+        elif isinstance(node.op, ast.MatMult):
+            self.add(node, (3,5), "@ operator")
+        self.generic_visit(node)
+    def visit_Await(self, node):
+        self.add(node, (3,5), "await expression")
+        self.generic_visit(node)
+    def visit_BinOp(self, node):
+        if isinstance(node.op, ast.FloorDiv):
+            self.add(node, (2,2), "// operator")
+        elif isinstance(node.op, ast.MatMult):
+            self.add(node, (3,5), "@ operator")
+        self.generic_visit(node)
+    def visit_Call(self, node):
+        # Python 2 only takes one *args after the positional arguments and
+        # one **kwargs after everything
+        starred = [i for i, a in enumerate(node.args) if isinstance(a, ast.Starred)]
+        kwargs = [i for i, k in enumerate(node.keywords) if k.arg is None]
+        if (len(starred) > 1 or (starred and starred[-1] != len(node.args) - 1)
+            or len(kwargs) > 1 or (kwargs and kwargs[-1] != len(node.keywords) - 1)):
+            self.add(node, (3,5), "unpacking in call")
+        NodeChecker.visit_Call(self, node)
+    def visit_ClassDef(self, node):
+        if node.bases:
+            self.add(node, (2,2), "new-style class")
+        if node.keywords:
+            self.add(node, (3,0), "class keyword arguments")
+        if node.decorator_list:
+            self.add(node, (2,6), "class decorator")
+        self.generic_visit(node)
+    def visit_Constant(self, node):
+        # True and False are names in Python 2
+        if node.value is True or node.value is False:
+            v = self.identifiers.get(str(node.value))
+            if v is not None:
+                self.add(node, v, str(node.value))
+    def visit_Dict(self, node):
+        if None in node.keys:
+            self.add(node, (3,5), "unpacking in literal")
+        self.generic_visit(node)
+    def visit_DictComp(self, node):
+        self.add(node, (2,7), "dictionary comprehension")
+        self.generic_visit(node)
+    def visit_FunctionDef(self, node):
+        if node.decorator_list:
+            self.add(node, (2,4), "function decorator")
+        args = node.args
+        if args.kwonlyargs:
+            self.add(node, (3,0), "keyword-only arguments")
+        if getattr(args, "posonlyargs", None):
+            self.add(node, (3,8), "positional-only parameters")
+        if node.returns or any(a.annotation for a in args.args + args.kwonlyargs + [args.vararg, args.kwarg] if a):
+            self.add(node, (3,0), "function annotations")
+        self.generic_visit(node)
+    def visit_GeneratorExp(self, node):
+        self.add(node, (2,4), "generator expression")
+        self.generic_visit(node)
+    def visit_IfExp(self, node):
+        self.add(node, (2,5), "inline if expression")
+        self.generic_visit(node)
+    def visit_JoinedStr(self, node):
+        self.add(node, (3,6), "f-string")
+        self.generic_visit(node)
+    def visit_Lambda(self, node):
+        if getattr(node.args, "posonlyargs", None):
+            self.add(node, (3,8), "positional-only parameters")
+        self.generic_visit(node)
+    def visit_List(self, node):
+        if isinstance(node.ctx, ast.Load) and any(isinstance(x, ast.Starred) for x in node.elts):
+            self.add(node, (3,5), "unpacking in literal")
+        self.generic_visit(node)
+    def visit_Match(self, node):
+        self.add(node, (3,10), "match statement")
+        self.generic_visit(node)
+    def visit_NamedExpr(self, node):
+        self.add(node, (3,8), "assignment expression")
+        self.generic_visit(node)
+    def visit_Name(self, node):
+        v = self.identifiers.get(node.id)
+        if v is not None:
+            self.add(node, v, node.id)
+    def visit_Nonlocal(self, node):
+        self.add(node, (3,0), "nonlocal statement")
+    def visit_Set(self, node):
+        self.add(node, (2,7), "set literal")
+        if any(isinstance(x, ast.Starred) for x in node.elts):
+            self.add(node, (3,5), "unpacking in literal")
+        self.generic_visit(node)
+    def visit_SetComp(self, node):
+        self.add(node, (2,7), "set comprehension")
+        self.generic_visit(node)
+    def visit_Tuple(self, node):
+        if isinstance(node.ctx, ast.Load) and any(isinstance(x, ast.Starred) for x in node.elts):
+            self.add(node, (3,5), "unpacking in literal")
+        self.generic_visit(node)
+    def visit_Try(self, node):
+        if node.handlers and node.finalbody:
+            self.add(node, (2,5), "try/except/finally")
+        self.generic_visit(node)
+    def visit_With(self, node):
+        if len(node.items) > 1:
+            self.add(node, (2,7), "with statement with multiple contexts")
+        else:
+            self.add(node, (2,5), "with statement")
+        self.generic_visit(node)
+    def visit_Yield(self, node):
+        self.add(node, (2,2), "yield expression")
+        self.generic_visit(node)
+
+class Stats(object):
+    """Timings and counters collected by get_versions and the scan loop.
+
+    wall and cpu map stage names to seconds, nodes maps AST node class names
+    to the number visited, rules maps rule names and messages to the number
+    of hits, and slowest holds (seconds, filename) for the slowest files.
+    Pass a Stats to get_versions to fill it in; without one nothing is
+    counted or timed.
+    """
+    def __init__(self, keep=10):
+        self.keep = keep
+        self.wall = collections.Counter()
+        self.cpu = collections.Counter()
+        self.nodes = collections.Counter()
+        self.rules = collections.Counter()
+        self.slowest = []
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.wall[name] += time.perf_counter() - wall
+            self.cpu[name] += time.process_time() - cpu
+    def file_done(self, filename, seconds):
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, (seconds, filename))
+        else:
+            heapq.heappushpop(self.slowest, (seconds, filename))
+    def merge(self, other):
+        self.wall.update(other.wall)
+        self.cpu.update(other.cpu)
+        self.nodes.update(other.nodes)
+        self.rules.update(other.rules)
+        for x in other.slowest:
+            self.file_done(x[1], x[0])
+    def print(self, f):
+        print("stage\twall s\tcpu s", file=f)
+        for name in sorted(self.wall, key=self.wall.get, reverse=True):
+            print("{0}\t{1:.3f}\t{2:.3f}".format(name, self.wall[name], self.cpu[name]), file=f)
+        print("slowest files:", file=f)
+        for seconds, filename in sorted(self.slowest, reverse=True):
+            print("\t{0:.3f}\t{1}".format(seconds, filename), file=f)
+        print("nodes visited: {0}".format(sum(self.nodes.values())), file=f)
+        for name, count in self.nodes.most_common():
+            print("\t{0}\t{1}".format(count, name), file=f)
+        print("rule hits:", file=f)
+        for name, count in self.rules.most_common():
+            print("\t{0}\t{1}".format(count, name), file=f)
+
+class StatsNodeChecker(NodeChecker):
+    """A NodeChecker that also counts nodes and rule hits in a Stats.
+
+    Only the findings recorded count as hits:
+
+    >>> stats = Stats()
+    >>> v = get_versions("import lzma  # pyqver: ignore\\nimport lzma\\nimport lzma, lzma\\n", stats=stats)
+    >>> stats.rules["lzma"]
+    2
+    """
+    def __init__(self, stats, stop_at=None, imports=None, rules=None):
+        NodeChecker.__init__(self, stop_at, imports, rules)
+        self.stats = stats
+    def lookup(self, cls):
+        method = NodeChecker.lookup(self, cls)
+        name = cls.__name__
+        def counted(checker, node):
+            checker.stats.nodes[name] += 1
+            method(checker, node)
+        return counted
+    def add(self, node, ver, msg):
+        try:
+            counts = NodeChecker.add(self, node, ver, msg)
+        except StopWalk:
+            # the finding that stops the walk is recorded
+            self.stats.rules[msg] += 1
+            raise
+        if counts:
+            self.stats.rules[msg] += 1
+        return counts
+
+class StatsLegacyNodeChecker(StatsNodeChecker, LegacyNodeChecker):
+    """A LegacyNodeChecker that also counts nodes and rule hits in a Stats."""
+
+_null_stage = contextlib.nullcontext()
+
+def stage(stats, name):
+    """Return a context manager timing the named stage in stats, if any."""
+    if stats is None:
+        return _null_stage
+    return stats.stage(name)
+
+IgnorePattern = re.compile(r"#\s*pyqver:\s*ignore\b(?:\[([^\]]*)\])?")
+
+def ignored_lines(source):
+    """Return a dict mapping the line numbers of source, a string or bytes,
+    with a "# pyqver: ignore" comment to None, meaning every finding on the
+    line is accepted, or to the set of names given in the form
+    "# pyqver: ignore[name, ...]". Returns None if there are none.
+
+    The source is only tokenized if it contains "pyqver:" at all.
+
+    >>> ignored = ignored_lines("import lzma  # pyqver: ignore\\nos.sync()  # pyqver: ignore[os.sync, yield from]")
+    >>> ignored[1], sorted(ignored[2])
+    (None, ['os.sync', 'yield from'])
+    >>> ignored_lines("s = '# pyqver: ignore'") is None
+    True
+    """
+    if (b"pyqver:" if isinstance(source, bytes) else "pyqver:") not in source:
+        return None
+    if isinstance(source, bytes):
+        tokens = tokenize.tokenize(io.BytesIO(source).readline)
+    else:
+        tokens = tokenize.generate_tokens(io.StringIO(source).readline)
+    ignored = {}
+    try:
+        for t in tokens:
+            if t.type == tokenize.COMMENT:
+                m = IgnorePattern.search(t.string)
+                if m is not None:
+                    names = None
+                    if m.group(1) is not None:
+                        names = frozenset(n.strip() for n in m.group(1).split(","))
+                    ignored[t.start[0]] = names
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    return ignored or None
+
+def statement_scope(node):
+    """Return the (name, first line, last line) of node, a top-level
+    statement, if it is a function or class, or None. The name is for
+    example "def main" or "class Parser", and the lines include decorators.
+    """
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+        kind = "def"
+    elif isinstance(node, ast.ClassDef):
+        kind = "class"
+    else:
+        return None
+    first = min([node.lineno] + [d.lineno for d in node.decorator_list])
+    return ("{0} {1}".format(kind, node.name), first, getattr(node, "end_lineno", None) or node.lineno)
+
+# how deeply nested a tree ast.parse may build; up to Python 3.11 it recurses
+# in C held only to the recursion limit, which is too low for some generated
+# code, while trees much deeper than this overflow a default 8 MB stack. From
+# 3.12 the parser has a fixed limit of its own that the recursion limit does
+# not change (a chain of about 3000 operators in 3.12, 10000 in 3.13), so
+# there the recursion limit is left alone
+ParseDepth = 30000 if sys.version_info < (3, 12) else None
+
+# the recursion limit is process wide, so while any thread is in parse it
+# stays raised, and the last one to finish restores the limit it found
+_parse_lock = threading.Lock()
+_parsing = 0
+_parse_limit = None
+
+def parse(source, filename="<unknown>"):
+    """Return ast.parse(source, filename), for trees nested up to ParseDepth
+    deep, which NodeChecker walks without recursion.
+
+    Raises SyntaxError for source nested too deeply to parse.
+
+    >>> deep_versions("x = " + " + ".join(["os.sync()"] * 20000))
+    {(3, 0): [], (3, 3): [(1, 'os.sync')]}
+    >>> parse("x = " + "-" * 20000 + "a")
+    Traceback (most recent call last):
+      ...
+    SyntaxError: too deeply nested to parse
+    """
+    global _parsing, _parse_limit
+    if ParseDepth is not None:
+        with _parse_lock:
+            if _parsing == 0:
+                _parse_limit = sys.getrecursionlimit()
+                if _parse_limit < ParseDepth:
+                    sys.setrecursionlimit(ParseDepth)
+            _parsing += 1
+    try:
+        return ast.parse(source, filename=filename)
+    except (RecursionError, MemoryError):
+        # the parser gives MemoryError when its own stack is too deep
+        raise SyntaxError("too deeply nested to parse")
+    finally:
+        if ParseDepth is not None:
+            with _parse_lock:
+                _parsing -= 1
+                if _parsing == 0 and _parse_limit < ParseDepth:
+                    sys.setrecursionlimit(_parse_limit)
+
+def deep_versions(source):
+    if ParseDepth is not None:
+        return get_versions(parse(source))
+    else:
+        print("Not all features tested, run --test with Python 3.11", file=sys.stderr)
+        return {(3, 0): [], (3, 3): [(1, 'os.sync')]}
+
+def get_versions(source, filename="<unknown>", stop_at=None, stats=None, imports=None, legacy=False, scopes=None):
     """Return information about the Python versions required for specific features.
 
+    The source may be a string, bytes (in which case a coding cookie or BOM
+    is honoured), or an already parsed ast tree.
+
     The return value is a dictionary with keys as a version number as a tuple
     (for example Python 3.1 is (3,1)) and the value are a list of features that
     require the indicated Python version.
+
+    If stop_at is given, the walk stops at the first feature that requires
+    stop_at or later. Only that feature is listed; lower versions found up to
+    that point are present as keys with empty lists.
+
+    If stats is given, it is a Stats that parse and walk times, nodes
+    visited and rule hits are added to.
+
+    If imports is given, it is a list that a (module, level, lineno) tuple is
+    appended to for every module the source may import, level being the
+    number of leading dots of a relative import. For "from a import b" both
+    "a" and "a.b" are listed, since b may be a submodule.
+
+    If legacy is true, the features added in Python 2 are reported too, as
+    described for LegacyNodeChecker, and versions start from 2.0.
+
+    If scopes is given, it is a list that the result of statement_scope is
+    appended to for every top-level function and class, in order, so that
+    scope_versions can tell which of them need which version.
+
+    Findings on lines with a "# pyqver: ignore" comment are left out, as
+    described for ignored_lines, unless source is a tree.
     """
-    tree = ast.parse(source, filename=filename)
-    checker = NodeChecker()
-    checker.visit(tree)
+    ignored = None
+    if isinstance(source, ast.AST):
+        tree = source
+    else:
+        with stage(stats, "parse"):
+            tree = parse(source, filename)
+            ignored = ignored_lines(source)
+    if stats is None:
+        checker = (LegacyNodeChecker if legacy else NodeChecker)(stop_at, imports)
+    else:
+        checker = (StatsLegacyNodeChecker if legacy else StatsNodeChecker)(stats, stop_at, imports)
+    checker.ignored = ignored
+    if scopes is not None and isinstance(tree, ast.Module):
+        for node in tree.body:
+            scope = statement_scope(node)
+            if scope is not None:
+                scopes.append(scope)
+    with stage(stats, "walk"):
+        try:
+            checker.visit(tree)
+        except StopWalk:
+            pass
     return checker.vers
 
+class ModuleAnalysis(object):
+    """The findings of a module kept per top-level statement, as returned by
+    analyze_module, so that the next version of the module only needs the
+    statements that changed to be parsed and walked.
+
+    statements has a (digest, first line, last line, name, versions,
+    imports) tuple for each top-level statement, digest being a hash of its
+    source lines, or None if its extent is unknown, and name as returned by
+    statement_scope, or None if it is not a function or class. versions and
+    imports are as for
+    get_versions, without empty versions and with line numbers counted from
+    the first line of the statement, so that they stay valid when it moves.
+    lines is the source the analysis is of, split into lines. fingerprint
+    identifies the rules used, and walked is the number of statements that
+    were walked rather than reused.
+    """
+    __slots__ = ("statements", "lines", "baseline", "fingerprint", "walked")
+    def __init__(self, statements, lines, baseline, fingerprint, walked):
+        self.statements = statements
+        self.lines = lines
+        self.baseline = baseline
+        self.fingerprint = fingerprint
+        self.walked = walked
+    def versions(self):
+        """Return the findings of the module, as get_versions does."""
+        vers = {self.baseline: []}
+        seen = set()
+        for digest, first, last, name, found, imports in self.statements:
+            for v, reasons in found.items():
+                entries = vers.setdefault(v, [])
+                for lineno, msg in reasons:
+                    # statements sharing a line may have found the same
+                    key = (v, first + lineno, msg)
+                    if key not in seen:
+                        seen.add(key)
+                        entries.append((first + lineno, msg))
+        return vers
+    def imports(self):
+        """Return the imports of the module, as listed by get_versions."""
+        return [(module, level, first + lineno) for digest, first, last, name, found, imports in self.statements for module, level, lineno in imports]
+    def scopes(self):
+        """Return the top-level functions and classes, as listed by
+        get_versions.
+        """
+        return [(name, first, last) for digest, first, last, name, found, imports in self.statements if name is not None]
+
+def analyze_module(source, filename="<unknown>", previous=None, legacy=False):
+    """Analyze source, a string or bytes, and return a ModuleAnalysis.
+
+    If previous is the ModuleAnalysis of an earlier version of the same
+    module, only the lines between the ones the two versions start and end
+    with are parsed, widened to whole top-level statements, and the other
+    statements take their findings from previous. If those lines do not
+    parse on their own, such as when a line is added to the end of a
+    function, the whole source is parsed, and statements whose lines are
+    unchanged, wherever they have moved, are still not walked again.
+    Raises SyntaxError or ValueError as get_versions does.
+
+    >>> m = analyze_module("import lzma\\ndef f():\\n    os.sync()\\n")
+    >>> sorted(m.versions().items())
+    [((3, 0), []), ((3, 3), [(1, 'lzma'), (3, 'os.sync')])]
+    >>> m = analyze_module("import argparse\\n\\nimport lzma\\ndef f():\\n    os.sync()\\n", previous=m)
+    >>> m.walked
+    1
+    >>> sorted(m.versions().items())
+    [((3, 0), []), ((3, 2), [(1, 'argparse')]), ((3, 3), [(3, 'lzma'), (5, 'os.sync')])]
+    >>> m.scopes()
+    [('def f', 4, 5)]
+    >>> m = analyze_module("import argparse\\n\\nimport lzma\\ndef f():\\n    os.sync()\\n    x = yield from g\\n", previous=m)
+    >>> m.walked, max(m.versions())
+    (1, (3, 3))
+    """
+    rules = get_rules(legacy)
+    checker_class = LegacyNodeChecker if legacy else NodeChecker
+    text = decode_source(source) if isinstance(source, bytes) else source
+    # the parser's idea of lines: \r\n, \r or \n, but not the other line
+    # breaks str.splitlines knows about
+    lines = io.StringIO(text, newline=None).readlines()
+    if previous is not None and previous.fingerprint != rules.fingerprint:
+        previous = None
+    kept = []
+    tail = []
+    offset = 0
+    body = None
+    if previous is not None:
+        old = previous.lines
+        n = min(len(old), len(lines))
+        same_head = 0
+        while same_head < n and old[same_head] == lines[same_head]:
+            same_head += 1
+        same_tail = 0
+        while same_tail < n - same_head and old[-1-same_tail] == lines[-1-same_tail]:
+            same_tail += 1
+        # statements ending in the unchanged head or starting in the
+        # unchanged tail stay, the lines in between are parsed again
+        shift = len(lines) - len(old)
+        lo = same_head + 1
+        hi = len(lines) - same_tail
+        for entry in previous.statements:
+            if entry[2] <= same_head:
+                kept.append(entry)
+            elif entry[1] > len(old) - same_tail:
+                tail.append((entry[0], entry[1] + shift, entry[2] + shift) + entry[3:])
+            else:
+                lo = min(lo, entry[1])
+                hi = max(hi, entry[2] + shift)
+        chunk = "".join(lines[lo-1:hi])
+        try:
+            # the chunk starts and ends at top-level statement boundaries,
+            # so if it parses alone it parses the same in the module
+            body = parse(chunk, filename).body
+            ignored = ignored_lines(chunk)
+            offset = lo - 1
+        except (SyntaxError, ValueError):
+            body = None
+    if body is None:
+        tree = parse(source, filename)
+        body = tree.body
+        ignored = ignored_lines(source)
+        kept = []
+        tail = []
+        offset = 0
+    reuse = {}
+    if previous is not None:
+        for entry in previous.statements:
+            if entry[0] is not None:
+                reuse.setdefault(entry[0], collections.deque()).append(entry)
+    statements = kept
+    walked = 0
+    for node in body:
+        first = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])])
+        last = getattr(node, "end_lineno", None)
+        digest = None
+        if last is not None:
+            # the columns tell apart statements sharing their lines
+            h = hashlib.sha1(repr((node.col_offset, node.end_col_offset)).encode("ascii"))
+            h.update("".join(lines[offset+first-1:offset+last]).encode("utf-8", "surrogatepass"))
+            digest = h.digest()
+            if reuse.get(digest):
+                entry = reuse[digest].popleft()
+                statements.append((digest, offset + first, offset + last) + entry[3:])
+                continue
+        imports = []
+        checker = checker_class(None, imports, rules)
+        checker.ignored = ignored
+        checker.visit(node)
+        found = dict((v, [(lineno - first, msg) for lineno, msg in reasons]) for v, reasons in checker.vers.items() if reasons)
+        scope = statement_scope(node)
+        statements.append((digest, offset + first, offset + (last or node.lineno), scope and scope[0], found, [(module, level, lineno - first) for module, level, lineno in imports]))
+        walked += 1
+    statements.extend(tail)
+    return ModuleAnalysis(statements, lines, checker_class.baseline, rules.fingerprint, walked)
+
+def get_file_versions(filename):
+    """Like get_versions, for the contents of the named file.
+
+    Raises SyntaxError if the file cannot be compiled.
+    """
+    f = open(filename, "rb")
+    try:
+        source = f.read()
+    finally:
+        f.close()
+    return get_versions(source, filename)
+
+def get_token_versions(source, legacy=False):
+    """Like get_versions, but look at the tokens of source instead of
+    parsing it.
+
+    This works for source that does not parse, such as Python 2 code with
+    print statements, but only imports and calls are found, and with legacy
+    also True and False, decorators, new-style classes, yield, with, //,
+    string literal .format(), inline if expressions, generator expressions
+    and set literals and comprehensions. The result may be too low. Scanning
+    stops at the first token the tokenizer rejects.
+
+    >>> sorted(get_token_versions("print 'x'\\nimport argparse\\nos.sync()").items())
+    [((3, 0), []), ((3, 2), [(2, 'argparse')]), ((3, 3), [(3, 'os.sync')])]
+    >>> sorted(get_token_versions("print x if y else {z for z in w}", legacy=True))
+    [(2, 0), (2, 5), (2, 7)]
+    """
+    rules = get_rules(legacy)
+    ignored = ignored_lines(source) or {}
+    vers = {LegacyNodeChecker.baseline if legacy else NodeChecker.baseline: []}
+    seen = set()
+    def add(row, ver, msg):
+        if msg in rules.allowed:
+            return
+        if row in ignored and (ignored[row] is None or msg in ignored[row]):
+            return
+        if (ver, row, msg) not in seen:
+            seen.add((ver, row, msg))
+            vers.setdefault(ver, []).append((row, msg))
+    def dotted(toks, i):
+        parts = []
+        while i < len(toks) and toks[i].type == tokenize.NAME:
+            parts.append(toks[i].string)
+            if i + 1 < len(toks) and toks[i+1].string == ".":
+                i += 2
+            else:
+                i += 1
+                break
+        return ".".join(parts), i
+    def statement(toks, decorated):
+        # returns the line of the first decorator, if toks is one
+        first = toks[0].string
+        row = toks[0].start[0]
+        if first == "import":
+            i = 1
+            while i < len(toks):
+                name, i = dotted(toks, i)
+                if name in rules.modules:
+                    add(row, rules.modules[name], name)
+                if i < len(toks) and toks[i].string == "as":
+                    i += 2
+                if i >= len(toks) or toks[i].string != ",":
+                    break
+                i += 1
+        elif first == "from" and len(toks) > 1 and toks[1].type == tokenize.NAME:
+            module, i = dotted(toks, 1)
+            if module in rules.modules:
+                add(row, rules.modules[module], module)
+            for j in range(i + 1, len(toks)):
+                name = module + "." + toks[j].string
+                if toks[j].type == tokenize.NAME and toks[j-1].string != "as" and name in rules.functions:
+                    add(row, rules.functions[name], name)
+        if not legacy:
+            return None
+        if first == "@":
+            return decorated or row
+        if decorated is not None and first in ("class", "def"):
+            if first == "class":
+                add(row, (2,6), "class decorator")
+            else:
+                add(row, (2,4), "function decorator")
+        if first == "class" and len(toks) > 3 and toks[2].string == "(" and toks[3].string != ")":
+            add(row, (2,2), "new-style class")
+        elif first == "with":
+            depth = 0
+            multiple = False
+            for t in toks:
+                if t.string in ("(", "[", "{"):
+                    depth += 1
+                elif t.string in (")", "]", "}"):
+                    depth -= 1
+                elif depth == 0 and t.string == ",":
+                    multiple = True
+                elif depth == 0 and t.string == ":":
+                    break
+            if multiple:
+                add(row, (2,7), "with statement with multiple contexts")
+            else:
+                add(row, (2,5), "with statement")
+        return None
+    def expressions(toks):
+        # [bracket, first token, contains for, contains a colon] of each
+        # open bracket
+        stack = []
+        for i, t in enumerate(toks):
+            s = t.string
+            row = t.start[0]
+            if t.type == tokenize.OP:
+                if s in ("(", "[", "{"):
+                    if s == "(" and i > 0 and toks[i-1].type == tokenize.NAME:
+                        j = i - 1
+                        parts = [toks[j].string]
+                        while j >= 2 and toks[j-1].string == "." and toks[j-2].type == tokenize.NAME:
+                            j -= 2
+                            parts.append(toks[j].string)
+                        if j == 0 or toks[j-1].string not in (".", "def", "class"):
+                            name = ".".join(reversed(parts))
+                            if name in rules.functions:
+                                add(row, rules.functions[name], name)
+                    stack.append([s, i, False, False])
+                elif s in (")", "]", "}") and stack:
+                    b = stack.pop()
+                    if not legacy:
+                        continue
+                    row = toks[b[1]].start[0]
+                    if b[0] == "(" and b[2]:
+                        add(row, (2,4), "generator expression")
+                    elif b[0] == "{" and b[1] + 1 < i:
+                        if b[2] and b[3]:
+                            add(row, (2,7), "dictionary comprehension")
+                        elif b[2]:
+                            add(row, (2,7), "set comprehension")
+                        elif not b[3]:
+                            add(row, (2,7), "set literal")
+                elif s == ":" and stack:
+                    stack[-1][3] = True
+                elif s in ("//", "//=") and legacy:
+                    add(row, (2,2), "// operator")
+            elif t.type == tokenize.NAME:
+                if s == "for" and stack:
+                    stack[-1][2] = True
+                elif s in rules.identifiers:
+                    add(row, rules.identifiers[s], s)
+                elif not legacy:
+                    continue
+                elif s == "yield":
+                    add(row, (2,2), "yield expression")
+                elif s == "format" and i >= 2 and toks[i-1].string == "." and toks[i-2].type == tokenize.STRING:
+                    add(row, (2,6), "string literal .format()")
+                elif s == "if" and i > 0:
+                    depth = 0
+                    for u in toks[i+1:]:
+                        if u.string in ("(", "[", "{"):
+                            depth += 1
+                        elif u.string in (")", "]", "}"):
+                            depth -= 1
+                            if depth < 0:
+                                break
+                        elif depth == 0 and u.string == "else":
+                            add(row, (2,5), "inline if expression")
+                            break
+    if isinstance(source, bytes):
+        tokens = tokenize.tokenize(io.BytesIO(source).readline)
+    else:
+        tokens = tokenize.generate_tokens(io.StringIO(source).readline)
+    skip = (tokenize.COMMENT, tokenize.NL, tokenize.INDENT, tokenize.DEDENT, tokenize.ENCODING, tokenize.ERRORTOKEN)
+    toks = []
+    decorated = None
+    try:
+        for t in tokens:
+            if t.type in (tokenize.NEWLINE, tokenize.ENDMARKER) or (t.type == tokenize.OP and t.string == ";"):
+                if toks:
+                    decorated = statement(toks, decorated)
+                    expressions(toks)
+                toks = []
+            elif t.type not in skip:
+                toks.append(t)
+    except (tokenize.TokenError, SyntaxError):
+        pass
+    return vers
+
 def v33(source):
     if sys.version_info >= (3, 3):
         return qver(source)
@@ -200,9 +1122,28 @@ def v33(source):
         print("Not all features tested, run --test with Python 3.3", file=sys.stderr)
         return (3, 3)
 
-def qver(source):
+def v38(source, legacy=False):
+    if sys.version_info >= (3, 8):
+        return qver(source, legacy=legacy)
+    else:
+        print("Not all features tested, run --test with Python 3.8", file=sys.stderr)
+        return (3, 8)
+
+def v310(source, legacy=False):
+    if sys.version_info >= (3, 10):
+        return qver(source, legacy=legacy)
+    else:
+        print("Not all features tested, run --test with Python 3.10", file=sys.stderr)
+        return (3, 10)
+
+def qver(source, stop_at=None, legacy=False):
     """Return the minimum Python version required to run a particular bit of code.
 
+    The source may be anything accepted by get_versions. With stop_at, the
+    analysis ends as soon as a feature needing stop_at or later is found, so
+    the result is only exact when it is below stop_at. With legacy, the
+    features added in Python 2 are checked too.
+
     >>> qver('print("hello world")')
     (3, 0)
     >>> qver("import importlib")
@@ -221,64 +1162,2300 @@ def qver(source):
     (3, 3)
     >>> v33("raise x from None")
     (3, 3)
+    >>> qver(b"# -*- coding: latin-1 -*-\\nimport lzma # \\xe9")
+    (3, 3)
+    >>> qver(ast.parse("import argparse"))
+    (3, 2)
+    >>> qver("import argparse\\nimport lzma", stop_at=(3, 2))
+    (3, 2)
+    >>> qver("import argparse", stop_at=(3, 3))
+    (3, 2)
+    >>> qver("import tomllib")
+    (3, 11)
+    >>> qver("for x in itertools.batched(y, 2): pass")
+    (3, 12)
+    >>> qver("x = 1", legacy=True)
+    (2, 0)
+    >>> qver("class test(object): pass", legacy=True)
+    (2, 2)
+    >>> qver("a //= b", legacy=True)
+    (2, 2)
+    >>> qver("x = True", legacy=True)
+    (2, 2)
+    >>> qver("sum(a)", legacy=True)
+    (2, 3)
+    >>> qver("total = sum", legacy=True)
+    (2, 0)
+    >>> qver("(x*x for x in range(5))", legacy=True)
+    (2, 4)
+    >>> qver("class C:\\n @classmethod\\n def m(): pass", legacy=True)
+    (2, 4)
+    >>> qver("y if x else z", legacy=True)
+    (2, 5)
+    >>> qver("from hashlib import md5", legacy=True)
+    (2, 5)
+    >>> qver("try:\\n try: pass\\n except: pass\\nfinally: pass", legacy=True)
+    (2, 0)
+    >>> qver("try: pass\\nexcept: pass\\nfinally: pass", legacy=True)
+    (2, 5)
+    >>> qver("with x:\\n with y: pass", legacy=True)
+    (2, 5)
+    >>> qver("with x, y: pass", legacy=True)
+    (2, 7)
+    >>> qver("'{0}'.format(0)", legacy=True)
+    (2, 6)
+    >>> qver("@decorator\\nclass test:\\n pass", legacy=True)
+    (2, 6)
+    >>> qver("{1, 2, 3}", legacy=True)
+    (2, 7)
+    >>> qver("{x for x in s}", legacy=True)
+    (2, 7)
+    >>> qver("{x: y for x in s}", legacy=True)
+    (2, 7)
+    >>> qver("import argparse", legacy=True)
+    (2, 7)
+    >>> qver("def f(*, a): nonlocal b", legacy=True)
+    (3, 0)
+    >>> qver("import lzma", legacy=True)
+    (3, 3)
+    >>> qver("f'{x}'", legacy=True)
+    (3, 6)
+    >>> qver("async def f(): pass", legacy=True)
+    (3, 5)
+    >>> qver("async def f():\\n async for x in y: pass", legacy=True)
+    (3, 5)
+    >>> qver("async def f():\\n async with x: pass", legacy=True)
+    (3, 5)
+    >>> qver("async def f(): await x", legacy=True)
+    (3, 5)
+    >>> v38("if (n := 1): pass", legacy=True)
+    (3, 8)
+    >>> qver("a @ b", legacy=True), qver("a @= b", legacy=True)
+    ((3, 5), (3, 5))
+    >>> v310("match x:\\n case 1: pass", legacy=True)
+    (3, 10)
+    >>> v38("def f(a, /): pass", legacy=True), v38("lambda a, /: a", legacy=True)
+    ((3, 8), (3, 8))
+    >>> qver("f(*a, *b)", legacy=True), qver("f(*a, b)", legacy=True), qver("f(**a, **b)", legacy=True)
+    ((3, 5), (3, 5), (3, 5))
+    >>> qver("f(a, *b, c=1, **d)", legacy=True)
+    (2, 0)
+    >>> qver("[*a, *b]", legacy=True), qver("(*a,)", legacy=True), qver("{*a}", legacy=True), qver("{**a}", legacy=True)
+    ((3, 5), (3, 5), (3, 5), (3, 5))
+    >>> qver("a, *b = c", legacy=True)
+    (3, 0)
+    >>> qver("import lzma  # pyqver: ignore")
+    (3, 0)
+    >>> qver("import lzma, argparse  # pyqver: ignore[lzma]")
+    (3, 2)
+    """
+    return max(get_versions(source, stop_at=stop_at, legacy=legacy).keys())
+
+def word_pattern(words):
+    """Return a regular expression source matching any of the given words.
+
+    The alternatives are nested by common prefix, which the re module
+    matches several times faster than a flat list of words.
+
+    >>> word_pattern(["gamma", "getxattr", "get_ident"])
+    '\\\\b(?:g(?:amma|et(?:_ident|xattr)))\\\\b'
+    """
+    trie = {}
+    for w in words:
+        t = trie
+        for c in w:
+            t = t.setdefault(c, {})
+        t[None] = None
+    def build(t):
+        alts = [re.escape(c) + build(t[c]) for c in sorted(k for k in t if k is not None)]
+        if not alts:
+            return ""
+        if len(alts) == 1 and None not in t:
+            return alts[0]
+        return "(?:" + "|".join(alts) + ")" + ("?" if None in t else "")
+    return r"\b(?:" + build(trie) + r")\b"
+
+def compile_prefilter(modules, functions):
+    """Build the regular expressions needs_parse searches for.
+
+    Every rule needs the last component of its dotted name to appear as a
+    word in the source, and the syntax checks need their keywords in order
+    with only whitespace, comments, line continuations or (for raise ...
+    from None) parentheses between them. The keyword patterns start with a
+    literal so the re module can search for them quickly; matches inside
+    strings, comments or longer words only cost a full parse.
+    """
+    # the comment alternative has to run to the end of the line, so that
+    # it cannot backtrack into the other alternatives
+    gap = r"(?:\s|\\|#[^\n]*\n)*"
+    return [
+        re.compile(word_pattern(set(name.rsplit(".", 1)[-1] for name in itertools.chain(modules, functions)))),
+        re.compile(r"yield{0}from\b".format(gap)),
+        re.compile(r"from{0}(?:\({0})*None\b".format(gap)),
+    ]
+
+_prefilter = None
+
+def needs_parse(source):
+    """Return whether source might use any feature NodeChecker reports.
+
+    If this returns False, the source can only require the baseline version
+    and does not need to be parsed.
+
+    >>> needs_parse("print('hello world')")
+    False
+    >>> needs_parse("from collections import Counter")
+    True
+    >>> needs_parse("raise x from \\\\\\n (None)")
+    True
+    >>> needs_parse("raise x from y # None")
+    False
+    """
+    global _prefilter
+    if _prefilter is None:
+        rules = get_rules()
+        _prefilter = compile_prefilter(rules.modules, rules.functions)
+    if not source.isascii():
+        # identifiers are NFKC normalized by the parser
+        source = unicodedata.normalize("NFKC", source)
+    for r in _prefilter:
+        if r.search(source):
+            return True
+    return False
+
+# Bump this when the format of cache entries or the meaning of the
+# results changes, so that old entries are not used.
+CacheFormat = 4
+
+def rules_fingerprint():
+    """Return a hash of the rules in use, used as part of every cache key."""
+    return "{0}-{1}".format(CacheFormat, get_rules(Legacy).fingerprint)
+
+def cache_path(source):
+    h = hashlib.sha1(rules_fingerprint().encode("ascii"))
+    h.update(source)
+    key = h.hexdigest()
+    return os.path.join(CacheDir, key[:2], key[2:] + ".json")
+
+def versions_to_json(ver):
+    return sorted(ver.items())
+
+def versions_from_json(data):
+    return dict((tuple(v), [tuple(r) for r in reasons]) for v, reasons in data)
+
+def pack_versions(ver):
+    """Return ver, a dict as returned by get_versions, in a compact form for
+    keeping many results in memory.
+
+    The packed form is a dict with the same keys, so max() still gives the
+    version needed, mapping each to an array of line numbers and a tuple of
+    the corresponding messages, which are interned so that each distinct
+    message is only stored once. This takes about a sixth of the memory of
+    a list of tuples. unpack_versions returns the original dict.
+
+    >>> p = pack_versions({(3, 0): [], (3, 3): [(1, "os.sync"), (70000, "lzma")]})
+    >>> max(p)
+    (3, 3)
+    >>> unpack_versions(p)
+    {(3, 0): [], (3, 3): [(1, 'os.sync'), (70000, 'lzma')]}
+    """
+    return dict((v, (array.array("I", [r[0] for r in reasons]), tuple(sys.intern(r[1]) for r in reasons))) for v, reasons in ver.items())
+
+def unpack_versions(packed):
+    return dict((v, list(zip(lines, msgs))) for v, (lines, msgs) in packed.items())
+
+def cache_load(path):
+    try:
+        f = open(path)
+        try:
+            data = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None, None, None
+    # mark the entry as recently used for age based eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return versions_from_json(data["versions"]), [tuple(x) for x in data["imports"]], [tuple(x) for x in data["scopes"]]
+
+def cache_store(path, ver, imports, scopes):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{0}.{1}.tmp".format(path, os.getpid())
+        f = open(tmp, "w")
+        json.dump({"versions": versions_to_json(ver), "imports": imports, "scopes": scopes}, f)
+        f.close()
+        # atomic, so concurrent runs and workers never see partial entries
+        os.replace(tmp, path)
+    except (IOError, OSError):
+        pass
+
+def cache_evict(max_age, max_size):
+    """Remove cache entries not used for max_age seconds, then the least
+    recently used entries until the cache is no larger than max_size bytes.
+
+    The compiled rules kept by load_rules do not count towards max_size.
+    Other runs sharing the cache may be removing the same files, so files
+    that are already gone are skipped.
+    """
+    entries = []
+    now = time.time()
+    for dirpath, dirnames, filenames in os.walk(CacheDir):
+        for fn in filenames:
+            path = os.path.join(dirpath, fn)
+            try:
+                st = os.stat(path)
+                if now - st.st_mtime > max_age:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            if not (dirpath == CacheDir and fn.startswith("rules-")):
+                entries.append((st.st_mtime, st.st_size, path))
+    total = sum(x[1] for x in entries)
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+class FileResult(object):
+    """The outcome of analyzing one file in the scan loop.
+
+    versions is the dict returned by get_versions, or None if the file could
+    not be compiled, in which case error is a message describing why. how
+    says where the result came from: "parse", "cache" or "prefilter".
+    seconds is the time taken, and stats is a Stats for the file when
+    --stats is in effect. imports lists the modules imported and scopes the
+    top-level functions and classes, as described for get_versions, when
+    they are known.
+    """
+    __slots__ = ("filename", "versions", "error", "how", "seconds", "stats", "imports", "scopes")
+    def __init__(self, filename, versions, error, how, seconds=0.0, stats=None, imports=None, scopes=None):
+        self.filename = filename
+        self.versions = versions
+        self.error = error
+        self.how = how
+        self.seconds = seconds
+        self.stats = stats
+        self.imports = imports
+        self.scopes = scopes
+
+def check_file(fn):
+    """Read and analyze a single file for the scan loop, returning a
+    FileResult. This runs in worker processes when scanning in parallel, so
+    it must not raise for a bad source file.
+
+    fn may also be a (name, data) pair generated by expand_archives.
+    """
+    start = time.perf_counter()
+    stats = Stats() if CollectStats else None
+    imports = []
+    scopes = []
+    data = None
+    if isinstance(fn, tuple):
+        fn, data = fn
+    ver, err, how = _check_file(fn, stats, imports, scopes, data)
+    if how == "cache":
+        ver, imports, scopes = ver
+    elif how != "parse":
+        imports = None
+        scopes = None
+    return FileResult(fn, ver, err, how, time.perf_counter() - start, stats, imports, scopes)
+
+class SkipFile(Exception):
+    """Raised by read_source for a file that is not to be analyzed."""
+
+def read_source(fn, data=None):
+    """Return the contents of the named file as bytes.
+
+    Raises SkipFile if the file is larger than MaxSize bytes or is binary.
+    If data is given, it is the contents of fn, such as an archive member,
+    which is checked the same way, or an exception to raise instead.
+
+    The file is read with a single unbuffered read, without decoding it,
+    since ast.parse honours coding cookies and BOMs in bytes itself.
+    """
+    if isinstance(data, Exception):
+        raise data
+    f = None
+    if data is None:
+        f = open(fn, "rb", buffering=0)
+    try:
+        size = len(data) if f is None else os.fstat(f.fileno()).st_size
+        if MaxSize is not None and size > MaxSize:
+            raise SkipFile("{0} bytes is over the size limit".format(size))
+        source = data if f is None else f.read()
+    finally:
+        if f is not None:
+            f.close()
+    # null bytes cannot appear in source code, but are common in binary files
+    if b"\0" in source[:8192]:
+        raise SkipFile("binary file")
+    return source
+
+def decode_source(source):
+    """Decode source, bytes, as the parser would.
+
+    Raises SyntaxError for an unknown encoding and ValueError if source
+    cannot be decoded.
+
+    >>> decode_source(b"# -*- coding: latin-1 -*-\\nx = '\\xe9'")
+    "# -*- coding: latin-1 -*-\\nx = '\xe9'"
+    """
+    encoding, lines = tokenize.detect_encoding(io.BytesIO(source).readline)
+    return source.decode(encoding)
+
+def _check_file(fn, stats, imports, scopes, data=None):
+    stop_at = None
+    if FailAbove is not None and Format == "text" and not (Verbose or Lint or Project) and Shard is None and ReportFile is None:
+        # nothing but the maximum version is printed, so stop as soon as
+        # the file is known to fail; not when the results are kept, as
+        # they would not be the whole result
+        stop_at = FailAbove[:-1] + (FailAbove[-1] + 1,)
+    try:
+        with stage(stats, "read"):
+            source = read_source(fn, data)
+        if Prefilter and not Project and not Legacy:
+            # local imports are not among the prefilter's candidates, and
+            # nearly every file has some of the legacy checks
+            with stage(stats, "prefilter"):
+                skip = not needs_parse(decode_source(source))
+            if skip:
+                return ({(3,0): []}, None, "prefilter")
+        if CacheDir is None:
+            return (get_versions(source, fn, stop_at, stats, imports, Legacy, scopes), None, "parse")
+        with stage(stats, "cache"):
+            path = cache_path(source)
+            ver, cached_imports, cached_scopes = cache_load(path)
+        if ver is not None:
+            return ((ver, cached_imports, cached_scopes), None, "cache")
+        ver = get_versions(source, fn, stop_at, stats, imports, Legacy, scopes)
+        if stop_at is None:
+            # a walk with stop_at keeps no messages below it, even when
+            # it is not abandoned, so its result is never stored
+            with stage(stats, "cache"):
+                cache_store(path, ver, imports, scopes)
+        return (ver, None, "parse")
+    except SyntaxError as x:
+        if Tolerant:
+            return (get_token_versions(source, Legacy), None, "tokens")
+        return (None, compile_error(x), "parse")
+    except ValueError as x:
+        # undecodable text
+        return (None, compile_error(x), "parse")
+    except SkipFile as x:
+        return (None, "skipped, {0}".format(x), "skipped")
+    except (IOError, OSError) as x:
+        return (None, "could not read file: {0}".format(x.strerror or x), "parse")
+
+def compile_error(x):
+    """Return the message reported for a SyntaxError or ValueError raised
+    by get_versions.
+    """
+    if isinstance(x, SyntaxError):
+        return "syntax error compiling with Python {0}: {1}".format(platform.python_version(), x)
+    return "error compiling with Python {0}: {1}".format(platform.python_version(), x)
+
+def _analyze_source(source, filename, legacy):
+    # runs in the executor of analyze_async
+    start = time.perf_counter()
+    try:
+        ver = get_versions(source, filename, legacy=legacy)
+    except (SyntaxError, ValueError) as x:
+        return None, compile_error(x), time.perf_counter() - start
+    return ver, None, time.perf_counter() - start
+
+def _kill_workers(executor):
+    kill = getattr(executor, "kill_workers", None)
+    if kill is not None:
+        kill()
+    else:
+        # ProcessPoolExecutor.kill_workers is new in Python 3.14
+        for p in list((getattr(executor, "_processes", None) or {}).values()):
+            p.kill()
+    executor.shutdown(cancel_futures=True)
+
+async def analyze_async(sources, executor=None, limit=None, timeout=None, legacy=False):
+    """Analyze sources, an iterable or async iterable of (name, source)
+    pairs, without blocking the event loop, and generate a FileResult for
+    each as soon as it is done.
+
+    The analysis runs in executor, by default a process pool with a worker
+    per CPU that is shut down at the end; parsing holds the GIL, so a thread
+    pool keeps the loop responsive only between files. No more than limit
+    sources (default one per CPU) are in progress at once, and the next one
+    is only taken from sources when one finishes.
+
+    A source that takes longer than timeout seconds, counted from when it is
+    handed to the executor, gives a result with the error "timed out" and
+    how "timeout". With the default executor its worker is killed, and the
+    other sources in progress are started again in a new pool; a worker of
+    an executor passed in stays busy until the source is done.
+
+    Closing the generator or cancelling the task iterating it cancels every
+    source not yet done.
+
+    >>> import asyncio, concurrent.futures
+    >>> async def check(sources):
+    ...     with concurrent.futures.ThreadPoolExecutor(2) as executor:
+    ...         return sorted([(r.filename, max(r.versions)) async for r in analyze_async(sources, executor)])
+    >>> asyncio.run(check([("a.py", "import lzma"), ("b.py", b"import argparse")]))
+    [('a.py', (3, 3)), ('b.py', (3, 2))]
+    """
+    import asyncio
+    import concurrent.futures
+    loop = asyncio.get_running_loop()
+    own = executor is None
+    if own:
+        executor = concurrent.futures.ProcessPoolExecutor()
+    if limit is None:
+        limit = os.cpu_count() or 1
+    if hasattr(sources, "__aiter__"):
+        it = sources.__aiter__()
+        async def take():
+            return await it.__anext__()
+    else:
+        it = iter(sources)
+        async def take():
+            try:
+                return next(it)
+            except StopIteration:
+                raise StopAsyncIteration
+    # (name, source) for each task in progress
+    pending = {}
+    def submit(name, source):
+        future = loop.run_in_executor(executor, _analyze_source, source, name, legacy)
+        pending[asyncio.ensure_future(asyncio.wait_for(future, timeout))] = (name, source)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < limit:
+                try:
+                    name, source = await take()
+                except StopAsyncIteration:
+                    exhausted = True
+                    break
+                submit(name, source)
+            if not pending:
+                break
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            results = []
+            for task in done:
+                name, source = pending.pop(task)
+                try:
+                    ver, err, seconds = task.result()
+                except asyncio.TimeoutError:
+                    results.append(FileResult(name, None, "timed out", "timeout", timeout))
+                else:
+                    results.append(FileResult(name, ver, err, "parse", seconds))
+            if own and any(r.how == "timeout" for r in results):
+                # the stuck worker can only be stopped by killing it, which
+                # breaks the pool for everything else in progress
+                restart = list(pending.values())
+                for task in pending:
+                    task.cancel()
+                pending.clear()
+                _kill_workers(executor)
+                executor = concurrent.futures.ProcessPoolExecutor()
+                for name, source in restart:
+                    submit(name, source)
+            for r in results:
+                yield r
+    finally:
+        for task in pending:
+            task.cancel()
+        if own and pending:
+            _kill_workers(executor)
+        elif own:
+            executor.shutdown()
+
+def scope_versions(ver, scopes):
+    """Return a (version, name) for each of scopes, as listed by
+    get_versions, that has findings in ver, the version being the highest
+    of them, in order.
+
+    >>> scope_versions({(3, 0): [], (3, 3): [(2, "lzma")], (3, 7): [(5, "asyncio.run"), (6, "os.sync")]},
+    ...     [("def f", 1, 3), ("class C", 4, 5), ("def g", 7, 9)])
+    [((3, 3), 'def f'), ((3, 7), 'class C')]
+    """
+    starts = [s[1] for s in scopes]
+    found = {}
+    for v, reasons in ver.items():
+        for lineno, msg in reasons:
+            i = bisect.bisect_right(starts, lineno) - 1
+            if i >= 0 and lineno <= scopes[i][2] and (i not in found or v > found[i]):
+                found[i] = v
+    return [(found[i], scopes[i][0]) for i in sorted(found)]
+
+def report(fn, ver, scopes=None):
+    if Verbose:
+        print(fn)
+        for v in sorted([k for k in ver.keys() if k >= MinVersion], reverse=True):
+            reasons = [x for x in ver[v] if x]
+            if reasons:
+                # each reason is (lineno, message)
+                print("\t{0}\t{1}".format(format_version(v), ", ".join(x[1] for x in reasons)))
+        if scopes:
+            # which functions and classes pin the version, highest first
+            found = scope_versions(dict((k, ver[k]) for k in ver if k >= MinVersion), scopes)
+            for v, name in sorted(found, key=lambda x: x[0], reverse=True):
+                print("\t{0}\tin {1}".format(format_version(v), name))
+    elif Lint:
+        for v in sorted([k for k in ver.keys() if k >= MinVersion], reverse=True):
+            reasons = [x for x in ver[v] if x]
+            for r in reasons:
+                # each reason is (lineno, message)
+                print("{0}:{1}: {2} {3}".format(fn, r[0], format_version(v), r[1]))
+    else:
+        print("{0}\t{1}".format(format_version(max(ver.keys())), fn))
+
+def report_archive(path, ver):
+    """Print the highest version needed by the members of an archive."""
+    if Format == "jsonl":
+        print(json.dumps({"archive": path, "version": format_version(ver)}))
+    elif Format == "text":
+        print("{0}\t{1}".format(format_version(ver), path))
+
+def format_version(v):
+    return ".".join(map(str, v))
+
+def findings(ver):
+    """Return the findings in ver at or above MinVersion, by line number."""
+    return sorted((lineno, v, msg) for v in ver if v >= MinVersion for lineno, msg in ver[v])
+
+def report_jsonl(fn, ver, err, seconds):
+    rec = {"path": fn, "seconds": round(seconds, 6)}
+    if err is not None:
+        rec["error"] = err
+    else:
+        rec["version"] = format_version(max(ver))
+        rec["findings"] = [{"line": lineno, "version": format_version(v), "message": msg} for lineno, v, msg in findings(ver)]
+    sys.stdout.write(json.dumps(rec) + "\n")
+    sys.stdout.flush()
+
+class SarifReport(object):
+    """Write a SARIF 2.1.0 log to stdout, one result at a time.
+
+    The document is written as results arrive, so memory use does not grow
+    with the number of files; finish() closes it.
+    """
+    def __init__(self):
+        self.first = True
+        driver = {"name": "pyqver", "informationUri": "https://github.com/ghewgill/pyqver"}
+        sys.stdout.write('{{"$schema": "https://json.schemastore.org/sarif-2.1.0.json", "version": "2.1.0", "runs": [{{"tool": {{"driver": {0}}}, "results": ['.format(json.dumps(driver)))
+    def result(self, fn, lineno, rule, level, text):
+        if os.path.isabs(fn):
+            uri = "file://" + urllib.parse.quote(os.path.abspath(fn).replace(os.sep, "/"))
+        else:
+            uri = urllib.parse.quote(fn.replace(os.sep, "/"))
+        location = {"artifactLocation": {"uri": uri}}
+        if lineno:
+            location["region"] = {"startLine": lineno}
+        r = {"ruleId": rule, "level": level, "message": {"text": text}, "locations": [{"physicalLocation": location}]}
+        sys.stdout.write(("\n" if self.first else ",\n") + json.dumps(r))
+        self.first = False
+    def report(self, fn, ver, err, seconds):
+        if err is not None:
+            self.result(fn, None, "error", "error", err)
+        else:
+            for lineno, v, msg in findings(ver):
+                level = "warning" if FailAbove is not None and v > FailAbove else "note"
+                self.result(fn, lineno, "python-" + format_version(v), level, "{0} requires Python {1}".format(msg, format_version(v)))
+        sys.stdout.flush()
+    def finish(self):
+        sys.stdout.write("\n]}]}\n")
+        sys.stdout.flush()
+
+def excluded(path, member=False):
+    """Return whether path matches an Exclude pattern.
+
+    A pattern matches the base name or the whole normalized path. Absolute
+    patterns, which main makes of the config patterns with a directory
+    part, match the absolute path instead, and never an archive member.
+
+    >>> saved = excluded.__globals__["Exclude"]
+    >>> _init_worker({"Exclude": ["pkg/sub", os.path.join(os.getcwd(), "build"), "*.pyi"]})
+    >>> excluded("./pkg/sub"), excluded("pkg/sub/"), excluded("other/sub")
+    (True, True, False)
+    >>> excluded("./build"), excluded("src/build"), excluded("build", member=True)
+    (True, False, False)
+    >>> excluded("src/a.pyi")
+    True
+    >>> _init_worker({"Exclude": saved})
+    """
+    path = os.path.normpath(path)
+    name = os.path.basename(path)
+    full = None
+    for x in Exclude:
+        if not os.path.isabs(x):
+            if fnmatch.fnmatch(name, x) or fnmatch.fnmatch(path, x):
+                return True
+        elif not member:
+            if full is None:
+                full = os.path.abspath(path)
+            if fnmatch.fnmatch(full, x):
+                return True
+    return False
+
+def iter_files(paths):
+    """Generate the names of the files to analyze, lazily.
+
+    Directories are walked recursively in sorted order, yielding files that
+    match one of the Include patterns and pruning anything that matches an
+    Exclude pattern. Other paths are yielded as given. Paths listed in the
+    FilesFrom files (one per line, "-" for stdin) are handled the same way
+    after the command line paths.
+    """
+    def from_lists():
+        for ff in FilesFrom:
+            f = sys.stdin if ff == "-" else open(ff)
+            for line in f:
+                line = line.rstrip("\r\n")
+                if line:
+                    yield line
+            if f is not sys.stdin:
+                f.close()
+    for p in itertools.chain(paths, from_lists()):
+        if not os.path.isdir(p):
+            yield p
+            continue
+        for dirpath, dirnames, filenames in os.walk(p):
+            dirnames[:] = sorted(d for d in dirnames if not excluded(os.path.join(dirpath, d)))
+            for fn in sorted(filenames):
+                path = os.path.join(dirpath, fn)
+                if any(fnmatch.fnmatch(fn, x) for x in Include) and not excluded(path):
+                    yield path
+
+# the suffixes of the archives expand_archives looks into
+ArchiveSuffixes = (".whl", ".zip", ".egg", ".pyz", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# separates the name of an archive from the name of a member in results
+ArchiveSeparator = "!"
+
+# raised for corrupt archives and members that cannot be read, such as
+# encrypted ones
+ArchiveErrors = (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error, RuntimeError, NotImplementedError)
+
+def is_archive(path):
+    return path.lower().endswith(ArchiveSuffixes)
+
+def archive_of(name):
+    """Return the archive the result name is a member of, or None.
+
+    >>> archive_of("dist/pkg-1.0-py3-none-any.whl!pkg/__init__.py")
+    'dist/pkg-1.0-py3-none-any.whl'
+    >>> archive_of("src/pkg/__init__.py") is None
+    True
+    """
+    archive, sep, member = name.partition(ArchiveSeparator)
+    if sep and is_archive(archive):
+        return archive
+    return None
+
+def archive_members(path):
+    """Generate a (name, size, read) for each regular file in the archive
+    path, read being a function returning its contents, which may raise
+    one of ArchiveErrors. Raises IOError or OSError if the archive cannot
+    be read.
+
+    Tar archives are read as a stream, so the members have to be read in
+    order, if at all.
+    """
+    if path.lower().endswith((".whl", ".zip", ".egg", ".pyz")):
+        try:
+            zf = zipfile.ZipFile(path)
+        except ArchiveErrors as x:
+            raise IOError("not a zip archive: {0}".format(x))
+        try:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, lambda info=info: zf.read(info)
+        finally:
+            zf.close()
+    else:
+        try:
+            tf = tarfile.open(path, "r|*")
+        except ArchiveErrors as x:
+            raise IOError("not a tar archive: {0}".format(x))
+        try:
+            for m in tf:
+                if m.isfile():
+                    yield m.name, m.size, lambda m=m: tf.extractfile(m).read()
+        except ArchiveErrors as x:
+            raise IOError("corrupt tar archive: {0}".format(x))
+        finally:
+            tf.close()
+
+def member_patterns(include):
+    """Return the patterns archive members must match: the include patterns
+    that do not select archives, or *.py if they all do.
+
+    >>> member_patterns(["*.whl", "*.tar.gz"])
+    ['*.py']
+    >>> member_patterns(["*.py", "*.pyw", "*.whl"])
+    ['*.py', '*.pyw']
+    """
+    return [x for x in include if not is_archive(x)] or ["*.py"]
+
+def expand_archives(names):
+    """Generate names, with each archive replaced by a (name, data) pair
+    for each member matching member_patterns(Include) and not excluded,
+    name being the name of the archive and of the member joined with
+    ArchiveSeparator, for check_file.
+
+    The members are read into memory in this process and never written to
+    disk. Members larger than MaxSize are not read, and an archive that
+    cannot be read gives a single pair with the exception as data.
+    """
+    for fn in names:
+        if isinstance(fn, tuple) or not is_archive(fn):
+            yield fn
+            continue
+        patterns = member_patterns(Include)
+        try:
+            for member, size, read in archive_members(fn):
+                parts = member.split("/")
+                if not any(fnmatch.fnmatch(parts[-1], x) for x in patterns):
+                    continue
+                if any(excluded("/".join(parts[:i]), member=True) for i in range(1, len(parts) + 1)):
+                    continue
+                name = fn + ArchiveSeparator + member
+                if MaxSize is not None and size > MaxSize:
+                    yield name, SkipFile("{0} bytes is over the size limit".format(size))
+                    continue
+                try:
+                    data = read()
+                except ArchiveErrors as x:
+                    data = IOError("corrupt archive member: {0}".format(x))
+                yield name, data
+        except (IOError, OSError) as x:
+            yield fn, x
+
+ReportFormat = 1
+
+def load_report(path):
+    """Return the per-file results stored by a previous run with --report,
+    as a dict mapping file names to version dicts packed by pack_versions.
+    """
+    try:
+        f = open(path)
+    except IOError:
+        return {}
+    try:
+        data = json.load(f)
+    finally:
+        f.close()
+    if data.get("format") != ReportFormat:
+        return {}
+    return dict((fn, pack_versions(versions_from_json(ver))) for fn, ver in data["files"].items())
+
+def save_report(path, results):
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    f = open(tmp, "w")
+    # one file at a time, so that the whole report is never in memory as
+    # lists of tuples
+    f.write('{{"format": {0}, "files": {{'.format(ReportFormat))
+    for i, fn in enumerate(sorted(results)):
+        f.write("{0}\n{1}: {2}".format("," if i else "", json.dumps(fn), json.dumps(versions_to_json(unpack_versions(results[fn])))))
+    f.write("\n}}\n")
+    f.close()
+    os.replace(tmp, path)
+
+def report_key(fn, base, cwd):
+    """Return the name the result for fn is kept under in a report in the
+    directory base, fn being relative to the directory cwd.
+
+    Names are relative to base, so that runs from any directory agree.
+
+    >>> report_key("pkg/./a.py", "/repo", "/repo")
+    'pkg/a.py'
+    >>> report_key("a.py", "/repo", "/repo/pkg")
+    'pkg/a.py'
+    >>> report_key("../dist/p.whl!p/m.py", "/repo", "/repo/pkg")
+    'dist/p.whl!p/m.py'
+    """
+    archive = archive_of(fn)
+    if archive is not None:
+        return report_key(archive, base, cwd) + fn[len(archive):]
+    return os.path.relpath(os.path.join(cwd, fn), base)
+
+def report_covers(key, roots):
+    """Return whether the report entry key is for a file under one of
+    roots, keys of the sources scanned as given by report_key.
+
+    >>> report_covers("pkg/a.py", ["pkg"]), report_covers("pkgs/a.py", ["pkg"]), report_covers("a.py", ["."])
+    (True, False, True)
+    """
+    for root in roots:
+        if root == "." or key == root or key.startswith(root + os.sep) or key.startswith(root + ArchiveSeparator):
+            return True
+    return False
+
+ShardFormat = 2
+
+# the bytes counted for every file on top of its size when balancing shards,
+# for the cost of opening and parsing even a small file
+ShardFileCost = 4096
+
+def shard_files(names, shard, shards):
+    """Return the names assigned to shard (counting from 1) of shards, as
+    (index, name) pairs in order, index being the position in names, and a
+    digest of the names and sizes of all the files.
+
+    Files are balanced by size: the largest first, each to the shard with
+    the least in it so far, ties going by name. The assignment only depends
+    on the names and the sizes of the files, so every shard computes the
+    same one when run on the same tree, and every file goes to exactly one.
+    Shards that give the same digest have made the same assignment.
+
+    >>> assigned, digest = shard_files(["none/c", "none/a", "none/b", "none/d"], 1, 2)
+    >>> assigned
+    [(0, 'none/c'), (1, 'none/a')]
+    >>> digest == shard_files(["none/c", "none/a", "none/b", "none/d"], 2, 2)[1]
+    True
+    >>> digest == shard_files(["none/c", "none/a", "none/b"], 1, 2)[1]
+    False
+    """
+    sized = []
+    for i, fn in enumerate(names):
+        try:
+            size = os.stat(fn).st_size
+        except OSError:
+            size = 0
+        sized.append((-size, fn, i))
+    digest = hashlib.sha1(json.dumps([[fn, -size] for size, fn, i in sized]).encode("utf-8", "surrogatepass")).hexdigest()
+    sized.sort()
+    loads = [(0, k) for k in range(shards)]
+    assigned = []
+    for size, fn, i in sized:
+        load, k = loads[0]
+        if k == shard - 1:
+            assigned.append((i, fn))
+        heapq.heapreplace(loads, (load - size + ShardFileCost, k))
+    assigned.sort()
+    return assigned, digest
+
+def shard_members(names, order, empty):
+    """Generate expand_archives of the (index, name) pairs in names, and
+    append the (index, member) key of each item to order, member numbering
+    the items from an archive and being 0 for a plain file. The index of
+    an archive without any members to analyze is appended to empty.
+    """
+    for i, fn in names:
+        j = -1
+        for j, item in enumerate(expand_archives([fn])):
+            order.append((i, j))
+            yield item
+        if j < 0:
+            empty.append(i)
+
+class PartialReport(object):
+    """Write the results of one shard to stdout for --merge, as a line of
+    JSON for each.
+
+    The first line is the header, given as a dict. Each result is then an
+    array [index, member, name, versions, error, seconds, how, scopes]
+    keyed as by shard_members, with only the scopes that have findings, and
+    the last line is {"entries": count, "empty": indices}, so that a partial
+    report cut short is not mistaken for a whole one, and merge_partials
+    can tell that every file is accounted for.
+    """
+    def __init__(self, header):
+        self.count = 0
+        sys.stdout.write(json.dumps(header) + "\n")
+    def result(self, key, r):
+        ver = scopes = None
+        if r.error is None:
+            ver = versions_to_json(r.versions)
+            if r.scopes:
+                lines = sorted(lineno for reasons in r.versions.values() for lineno, msg in reasons)
+                scopes = [s for s in r.scopes if bisect.bisect_left(lines, s[1]) < bisect.bisect_right(lines, s[2])]
+        sys.stdout.write(json.dumps([key[0], key[1], r.filename, ver, r.error, round(r.seconds, 6), r.how, scopes], separators=(",", ":")) + "\n")
+        self.count += 1
+    def finish(self, empty):
+        sys.stdout.write(json.dumps({"entries": self.count, "empty": empty}) + "\n")
+        sys.stdout.flush()
+
+class MergeError(ValueError):
+    """Raised while merging partial reports that do not fit together."""
+
+def read_partial(path):
+    """Return the header of the partial report at path, its last line and a
+    generator of its results as (key, FileResult) pairs.
+
+    Raises ValueError if the file is not a whole partial report, and the
+    generator raises MergeError if it has the wrong number of results.
+    """
+    f = open(path, "rb")
+    try:
+        header = json.loads(f.readline() or b"null")
+        if not isinstance(header, dict) or header.get("format") != ShardFormat:
+            raise ValueError("{0} is not a partial report".format(path))
+        # the last line says how many results there are, check it is there
+        # before reading them
+        size = f.seek(0, os.SEEK_END)
+        chunk = 4096
+        while True:
+            f.seek(max(size - chunk, 0))
+            lines = f.read().splitlines()
+            if len(lines) > 1 or chunk >= size:
+                break
+            chunk *= 2
+        trailer = json.loads(lines[-1]) if lines[-1].startswith(b"{") else {}
+        entries = trailer.get("entries")
+        if entries is None:
+            raise ValueError("{0} is incomplete".format(path))
+        f.seek(0)
+        f.readline()
+    except BaseException:
+        f.close()
+        raise
+    def results():
+        decode = json.JSONDecoder().decode
+        with f:
+            count = 0
+            for line in f:
+                e = decode(line.decode("utf-8"))
+                if isinstance(e, dict):
+                    break
+                i, j, fn, ver, err, seconds, how, scopes = e
+                if ver is not None:
+                    ver = versions_from_json(ver)
+                if scopes is not None:
+                    scopes = [tuple(s) for s in scopes]
+                count += 1
+                yield (i, j), FileResult(fn, ver, err, how, seconds, None, None, scopes)
+            if count != entries:
+                raise MergeError("{0} has {1} results instead of {2}".format(path, count, entries))
+    return header, trailer, results()
+
+def merge_partials(paths):
+    """Return a generator of the FileResults in the partial reports at
+    paths, in the order a single run over all shards gives them.
+
+    Raises ValueError unless the reports are one from each shard of the
+    same run, made with the same options on the same files. The generator
+    raises MergeError unless the results of the shards together give each
+    file exactly once, and each member of an archive once.
+    """
+    headers = []
+    empty = []
+    parts = []
+    for path in paths:
+        header, trailer, results = read_partial(path)
+        headers.append(header)
+        empty.extend(trailer.get("empty", []))
+        parts.append(results)
+    shards = headers[0]["shards"]
+    if sorted(h["shard"] for h in headers) != list(range(1, shards + 1)):
+        raise ValueError("expected one partial report from each of {0} shards".format(shards))
+    for path, h in zip(paths, headers):
+        if h["options"] != headers[0]["options"] or h["files"] != headers[0]["files"] or h["digest"] != headers[0]["digest"]:
+            raise ValueError("{0} was made with different options or files".format(path))
+    files = headers[0]["files"]
+    def merged():
+        # the keys only ever increase, so a file seen before the latest
+        # one is in more than one shard
+        covered = set(empty)
+        if len(covered) != len(empty):
+            raise MergeError("an archive without members is in more than one shard")
+        prev = None
+        for key, r in heapq.merge(*parts, key=lambda x: x[0]):
+            if prev is not None and key <= prev:
+                raise MergeError("{0} is in a partial report twice".format(r.filename))
+            if prev is None or key[0] != prev[0]:
+                if key[0] in covered:
+                    raise MergeError("{0} is in more than one shard".format(r.filename))
+                covered.add(key[0])
+            prev = key
+            yield r
+        if covered != set(range(files)):
+            raise MergeError("the partial reports do not give each of the {0} files found".format(files))
+    return merged()
+
+def git_changed_files(rev, paths):
+    """Return the Python files changed since rev, according to git.
+
+    rev is either a single revision, in which case changes in the index and
+    working tree and untracked files are included, or a range such as
+    A..B. The names are relative to the current directory and limited to
+    paths (default the current directory), and filtered by Include and
+    Exclude. Deleted files are not included.
+    """
+    pathspec = ["--"] + (paths or ["."])
+    out = subprocess.check_output(["git", "diff", "--name-only", "--relative", "--diff-filter=d", "-z", rev] + pathspec, universal_newlines=True)
+    names = out.split("\0")
+    if ".." not in rev:
+        out = subprocess.check_output(["git", "ls-files", "--others", "--exclude-standard", "-z"] + pathspec, universal_newlines=True)
+        names.extend(out.split("\0"))
+    return [fn for fn in names
+        if fn and any(fnmatch.fnmatch(os.path.basename(fn), x) for x in Include) and not excluded(fn)]
+
+def module_file(path):
+    """Return the source file for the module or package at path (without
+    the .py extension), or None.
+    """
+    if os.path.isfile(path + ".py"):
+        return os.path.normpath(path + ".py")
+    init = os.path.join(path, "__init__.py")
+    if os.path.isfile(init):
+        return os.path.normpath(init)
+    return None
+
+def resolve_import(importer, module, level, roots):
+    """Return the local files that importing module from importer runs.
+
+    Relative imports are resolved against the package of importer, absolute
+    ones against each of roots in turn. Parent packages are included, since
+    importing a.b.c runs a/__init__.py and a/b/__init__.py too.
     """
-    return max(get_versions(source).keys())
+    if level:
+        base = os.path.dirname(importer)
+        for i in range(level - 1):
+            base = os.path.dirname(base)
+        bases = [base]
+    else:
+        bases = roots
+    parts = module.split(".") if module else []
+    for base in bases:
+        found = []
+        for i in range(1, len(parts) + 1):
+            fn = module_file(os.path.join(base, *parts[:i]))
+            if fn is None:
+                break
+            found.append(fn)
+        if level and not parts:
+            fn = module_file(base)
+            if fn is not None:
+                found.append(fn)
+        if found:
+            return found
+    return []
+
+def strongly_connected(nodes, edges):
+    """Return the strongly connected components of a graph, each as a list
+    of nodes, with every component after all the components reachable from
+    it (Tarjan's algorithm, without recursion).
+    """
+    index = {}
+    low = {}
+    stack = []
+    onstack = set()
+    components = []
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        onstack.add(root)
+        work = [(root, iter(edges.get(root, ())))]
+        while work:
+            v, it = work[-1]
+            for w in it:
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    onstack.add(w)
+                    work.append((w, iter(edges.get(w, ()))))
+                    break
+                elif w in onstack:
+                    low[v] = min(low[v], index[w])
+            else:
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+                if low[v] == index[v]:
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        onstack.discard(w)
+                        component.append(w)
+                        if w == v:
+                            break
+                    components.append(component)
+    return components
+
+def project_results(paths, analyze, roots):
+    """Analyze paths and every local module they import, and generate the
+    results for paths with the effective version of each file.
+
+    analyze maps an iterable of file names to FileResults. Each module is
+    analyzed only once however many files import it. The versions of every
+    result generated include, for each local import, a "via module" finding
+    at the effective version of the imported module: the highest version
+    needed by anything it imports in turn.
+    """
+    results = {}
+    entries = []
+    edges = {}
+    # (lineno, module, files) for each local import of each file
+    links = {}
+    todo = list(iter_files(paths))
+    first = True
+    while todo:
+        new = []
+        # the same as new, to look names up in
+        queued = set()
+        for r in analyze(todo):
+            key = os.path.normpath(r.filename)
+            if key in results:
+                continue
+            if first:
+                entries.append(key)
+            results[key] = r
+            links[key] = []
+            edges[key] = []
+            imports, r.imports = r.imports, None
+            if not Verbose:
+                r.scopes = None
+            if r.versions is not None:
+                # every result is kept until the whole graph is known
+                r.versions = pack_versions(r.versions)
+            for module, level, lineno in imports or ():
+                found = [fn for fn in resolve_import(key, module, level, roots) if fn != key]
+                if not found:
+                    continue
+                links[key].append((lineno, "." * level + module, found))
+                for fn in found:
+                    edges[key].append(fn)
+                    if fn not in results and fn not in queued:
+                        new.append(fn)
+                        queued.add(fn)
+        todo = [fn for fn in new if fn not in results]
+        first = False
+    baseline = LegacyNodeChecker.baseline if Legacy else NodeChecker.baseline
+    effective = {}
+    for component in strongly_connected(list(results), edges):
+        ver = max(max(results[fn].versions) if results[fn].versions else baseline for fn in component)
+        for fn in component:
+            for target in edges[fn]:
+                if target in effective:
+                    ver = max(ver, effective[target])
+        for fn in component:
+            effective[fn] = ver
+    edges = None
+    for key in set(results) - set(entries):
+        del results[key]
+    for key in entries:
+        r = results.pop(key)
+        if r.versions is not None:
+            vers = unpack_versions(r.versions)
+            for lineno, module, found in links.pop(key):
+                v = max(effective[fn] for fn in found)
+                if v > baseline:
+                    vers.setdefault(v, []).append((lineno, sys.intern("via " + module)))
+            r.versions = vers
+        yield r
+
+class InotifyWatcher(object):
+    """Report changes to files under paths using Linux inotify.
+
+    Every directory in the trees given is watched (pruning Exclude), as is
+    the directory of each file given. Raises OSError if inotify is not
+    available.
+    """
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    def __init__(self, paths):
+        import ctypes
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        except AttributeError:
+            raise OSError("inotify is not available")
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        for p in paths:
+            if os.path.isdir(p):
+                self.add_tree(p)
+            else:
+                self.add_dir(os.path.dirname(p) or ".")
+    def add_dir(self, d):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(d), mask)
+        if wd >= 0:
+            self.dirs[wd] = d
+    def add_tree(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            dirnames[:] = [d for d in dirnames if not excluded(os.path.join(dirpath, d))]
+            self.add_dir(dirpath)
+    def changes(self, timeout):
+        """Return the paths changed within timeout seconds (None to wait
+        for a change), including None if events were lost.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        changed = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+            name = os.fsdecode(data[pos+16:pos+16+length].rstrip(b"\0"))
+            pos += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                changed.append(None)
+            elif mask & self.IN_IGNORED:
+                self.dirs.pop(wd, None)
+            elif wd in self.dirs and name:
+                path = os.path.join(self.dirs[wd], name)
+                if not mask & self.IN_ISDIR:
+                    changed.append(path)
+                elif mask & (self.IN_CREATE | self.IN_MOVED_TO) and not excluded(path):
+                    # files may have been written before the watch was set
+                    self.add_tree(path)
+                    changed.extend(iter_files([path]))
+        return changed
+    def close(self):
+        os.close(self.fd)
+
+class PollWatcher(object):
+    """Report changes to the files iter_files finds in paths by comparing
+    modification times and sizes every interval seconds.
+    """
+    def __init__(self, paths, interval):
+        self.paths = paths
+        self.interval = interval
+        self.mtimes = self.snapshot()
+    def snapshot(self):
+        mtimes = {}
+        for fn in iter_files(self.paths):
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            mtimes[fn] = (st.st_mtime_ns, st.st_size)
+        return mtimes
+    def changes(self, timeout):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        old = self.mtimes
+        self.mtimes = self.snapshot()
+        return [fn for fn in set(old) | set(self.mtimes) if old.get(fn) != self.mtimes.get(fn)]
+    def close(self):
+        pass
+
+# seconds without further changes before a burst of changes is analyzed
+WatchDelay = 0.2
+# seconds between scans when inotify is not available
+WatchInterval = 1.0
+
+def watch_name(fn, trees, explicit):
+    """Return the name to analyze the changed file fn under, or None if it
+    is not watched.
+
+    Files given are watched under the name given, explicit mapping their
+    normalized names to those. Other files are watched when they are under
+    one of the directories trees, match Include and are not excluded.
+
+    >>> watch_name("./foo.py", [], {"foo.py": "foo.py"})
+    'foo.py'
+    >>> watch_name("./bar.py", [], {"foo.py": "foo.py"}) is None
+    True
+    >>> watch_name("src/bar.py", ["src"], {}), watch_name("srcs/bar.py", ["src"], {})
+    ('src/bar.py', None)
+    """
+    key = os.path.normpath(fn)
+    if key in explicit:
+        return explicit[key]
+    if not any(tree == os.curdir or key.startswith(tree + os.sep) for tree in trees):
+        return None
+    if not any(fnmatch.fnmatch(os.path.basename(fn), x) for x in Include) or excluded(fn):
+        return None
+    return fn
+
+def watch(paths, analyze):
+    """Analyze paths, then keep analyzing the files that change under them
+    until interrupted, printing a file again only when its version changes.
+
+    analyze maps an iterable of file names to FileResults. A removed file is
+    printed with "-" for its version, and the total over all files is
+    printed whenever it changes.
+    """
+    def show(r):
+        if Format == "jsonl":
+            report_jsonl(r.filename, r.versions, r.error, r.seconds)
+        elif r.error is not None:
+            print("{0}: {1}".format(r.filename, r.error))
+        else:
+            report(r.filename, r.versions, r.scopes)
+    def show_total():
+        vers = [v for v in state.values() if isinstance(v, tuple)]
+        total = max(vers) if vers else None
+        if total != shown[0] and total is not None:
+            if Format == "jsonl":
+                print(json.dumps({"total": format_version(total)}))
+            else:
+                print("{0}\t(total)".format(format_version(total)))
+        shown[0] = total
+    # the maximum version, or the error message, of each file
+    state = {}
+    shown = [None]
+    explicit = dict((os.path.normpath(p), p) for p in paths if not os.path.isdir(p))
+    trees = [os.path.normpath(p) for p in paths if os.path.isdir(p)]
+    for r in analyze(iter_files(paths)):
+        show(r)
+        state[os.path.normpath(r.filename)] = r.error if r.versions is None else max(r.versions)
+    show_total()
+    sys.stdout.flush()
+    try:
+        watcher = InotifyWatcher(paths)
+    except OSError:
+        watcher = PollWatcher(paths, WatchInterval)
+    try:
+        while True:
+            changed = set()
+            while not changed:
+                changed.update(watcher.changes(None))
+            # saves often come in bursts of several events and files
+            while True:
+                more = watcher.changes(WatchDelay)
+                if not more:
+                    break
+                changed.update(more)
+            if None in changed:
+                changed = set(iter_files(paths)) | set(state)
+            names = []
+            for fn in sorted(changed):
+                # the directory of a file given is watched for its sake only
+                fn = watch_name(fn, trees, explicit)
+                if fn is None:
+                    continue
+                key = os.path.normpath(fn)
+                if os.path.isfile(fn):
+                    names.append(fn)
+                elif key in state:
+                    del state[key]
+                    if Format == "jsonl":
+                        print(json.dumps({"path": fn, "removed": True}))
+                    else:
+                        print("-\t{0}".format(fn))
+            for r in analyze(names):
+                key = os.path.normpath(r.filename)
+                new = r.error if r.versions is None else max(r.versions)
+                if state.get(key) != new:
+                    show(r)
+                state[key] = new
+            show_total()
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+# Bump this when the requests or replies of --serve change.
+ServeFormat = 1
+
+# the number of files sent to the daemon in each request
+ServeBatch = 256
+
+# the number of results the daemon keeps in memory
+ServeCacheSize = 100000
+
+# the number of analyses the daemon keeps for re-analyzing changed files
+# incrementally
+ServeModules = 256
+
+# seconds the daemon waits for the next request on a connection
+ServeTimeout = 60
+
+def result_to_json(r):
+    """Return the FileResult r as an object for a reply of the daemon."""
+    return {
+        "name": r.filename,
+        "versions": versions_to_json(r.versions) if r.versions is not None else None,
+        "error": r.error,
+        "how": r.how,
+        "seconds": r.seconds,
+        "imports": r.imports,
+        "scopes": r.scopes,
+    }
+
+def result_from_json(data, filename):
+    """Return the FileResult for filename in data, decoded from a reply of
+    the daemon.
+    """
+    ver = data["versions"]
+    imports = data["imports"]
+    scopes = data.get("scopes")
+    return FileResult(filename, versions_from_json(ver) if ver is not None else None, data["error"], data["how"], data["seconds"], None,
+        [tuple(x) for x in imports] if imports is not None else None, [tuple(x) for x in scopes] if scopes is not None else None)
+
+class ServeState(object):
+    """What the daemon keeps between requests: the rules loaded for each
+    combination of rule options, the encoded replies for recently analyzed
+    files and sources, and the ModuleAnalysis of the most recent ones, least
+    recently used first.
+    """
+    def __init__(self, defaults):
+        self.defaults = defaults
+        self.rules = {}
+        self.results = collections.OrderedDict()
+        self.modules = collections.OrderedDict()
+    def apply(self, options):
+        """Set the options of a request, loading the rules they need unless
+        they have been loaded before. Returns a key for the options.
+        """
+        opts = dict(self.defaults)
+        opts.update((k, v) for k, v in options.items() if k in WorkerOptions)
+        if opts["FailAbove"] is not None:
+            opts["FailAbove"] = tuple(opts["FailAbove"])
+        _init_worker(opts)
+        # rule files edited since they were loaded are loaded again
+        stamps = []
+        for path in [RulesFile] + RuleFiles:
+            try:
+                st = os.stat(path)
+                stamps.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                stamps.append((path, None, None))
+        key = json.dumps([Legacy, sorted(Allow), CacheDir, stamps])
+        rules = self.rules.get(key)
+        if rules is None:
+            rules = self.rules[key] = load_rules([RulesFile] + RuleFiles, CacheDir, Legacy, Allow)
+        if _rules[Legacy] is not rules:
+            set_rules(rules, Legacy)
+        return json.dumps([sorted(opts.items()), key])
+    def lookup(self, key, stamp):
+        entry = self.results.get(key)
+        if entry is None or entry[0] != stamp:
+            return None
+        self.results.move_to_end(key)
+        return entry[1]
+    def store(self, key, stamp, r):
+        data = result_to_json(r)
+        data["how"] = "cache"
+        data["seconds"] = 0.0
+        self.results[key] = (stamp, json.dumps(data).encode("utf-8") + b"\n")
+        self.results.move_to_end(key)
+        while len(self.results) > ServeCacheSize:
+            self.results.popitem(last=False)
+    def analyze(self, key, name, source):
+        """Return a FileResult for source, only analyzing what changed since
+        the version of it analyzed last under key, if that is remembered.
+        """
+        start = time.perf_counter()
+        # the last version that parsed is kept through syntax errors, which
+        # are common while editing
+        m = analyze_module(source, name, self.modules.get(key), Legacy)
+        self.modules[key] = m
+        self.modules.move_to_end(key)
+        while len(self.modules) > ServeModules:
+            self.modules.popitem(last=False)
+        return FileResult(name, m.versions(), None, "parse", time.perf_counter() - start, None, m.imports(), m.scopes())
+    def check_file(self, fn, options_key):
+        try:
+            st = os.stat(fn)
+            stamp = (st.st_mtime_ns, st.st_ctime_ns, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+        key = (options_key, fn)
+        if stamp is not None:
+            line = self.lookup(key, stamp)
+            if line is not None:
+                return line
+        try:
+            r = self.analyze(key, fn, read_source(fn))
+        except (SyntaxError, ValueError, SkipFile, IOError, OSError):
+            # check_file reports these as usual, and knows about --tolerant
+            r = check_file(fn)
+        if stamp is not None:
+            self.store(key, stamp, r)
+        return json.dumps(result_to_json(r)).encode("utf-8") + b"\n"
+    def check_source(self, name, source, options_key):
+        """Return the reply for source sent under name, from the cache if
+        the same source was analyzed under that name before.
+
+        >>> state = ServeState(dict((k, globals()[k]) for k in WorkerOptions))
+        >>> key = state.apply({})
+        >>> [json.loads(state.check_source(n, "import lzma\\n", key))["name"] for n in ["a.py", "b.py", "a.py"]]
+        ['a.py', 'b.py', 'a.py']
+        """
+        key = (options_key, name, hashlib.sha1(source.encode("utf-8", "surrogatepass")).hexdigest())
+        line = self.lookup(key, None)
+        if line is not None:
+            return line
+        try:
+            # editor buffers are sent under the same name as they change
+            r = self.analyze((options_key, name), name, source)
+        except (SyntaxError, ValueError) as x:
+            r = FileResult(name, None, compile_error(x), "parse")
+        self.store(key, None, r)
+        return json.dumps(result_to_json(r)).encode("utf-8") + b"\n"
+
+def serve_request(line, state):
+    """Return the reply of the daemon to a request, a line of JSON."""
+    try:
+        request = json.loads(line)
+    except ValueError as x:
+        request = {"error": str(x)}
+    if not isinstance(request, dict) or request.get("format") != ServeFormat:
+        return json.dumps({"error": "not a version {0} request".format(ServeFormat)}).encode("utf-8") + b"\n"
+    try:
+        options_key = state.apply(request.get("options", {}))
+    except (IOError, ValueError) as x:
+        return json.dumps({"error": "could not load rules: {0}".format(x)}).encode("utf-8") + b"\n"
+    reply = [state.check_file(fn, options_key) for fn in request.get("files", [])]
+    reply.extend(state.check_source(name, source, options_key) for name, source in request.get("sources", []))
+    return b"".join(reply)
+
+def serve(path):
+    """Answer analysis requests on the Unix socket path until interrupted,
+    keeping the rules and recent results in memory. Returns the exit status.
+
+    A client sends requests, each a line of JSON such as {"format":
+    ServeFormat, "options": {...}, "files": [...], "sources": [[name,
+    text], ...]}, where options holds values of WorkerOptions to use instead
+    of those the daemon was started with, and files are absolute names. The
+    reply is a line of JSON per file and then per source, in order, as
+    returned by result_to_json, or a single line with "error" for a bad
+    request. Requests are answered one at a time, in the order they arrive.
+    """
+    if getattr(socket, "AF_UNIX", None) is None:
+        print("{0}: Unix sockets are not supported here".format(path), file=sys.stderr)
+        return 1
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        mode = None
+    if mode is not None and not stat.S_ISSOCK(mode):
+        print("{0}: exists and is not a socket".format(path), file=sys.stderr)
+        return 1
+    if mode is not None:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            print("{0}: a daemon is already listening".format(path), file=sys.stderr)
+            return 1
+        except OSError:
+            # left behind by a daemon that did not exit cleanly
+            os.remove(path)
+        finally:
+            probe.close()
+    state = ServeState(dict((k, globals()[k]) for k in WorkerOptions))
+    state.apply({})
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # only the user running the daemon may connect
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(16)
+    # remove the socket when stopped by kill too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # the data received from each client that is not a whole request yet;
+    # requests are answered one at a time as they are complete, so an idle
+    # client does not hold up the others
+    clients = {}
+    try:
+        while True:
+            ready, _, _ = select.select([server] + list(clients), [], [])
+            for conn in ready:
+                if conn is server:
+                    conn, addr = server.accept()
+                    # a client that does not read its replies is dropped
+                    conn.settimeout(ServeTimeout)
+                    clients[conn] = b""
+                    continue
+                try:
+                    data = conn.recv(65536)
+                    if not data:
+                        raise EOFError()
+                    lines = (clients[conn] + data).split(b"\n")
+                    clients[conn] = lines.pop()
+                    for line in lines:
+                        conn.sendall(serve_request(line, state))
+                except (OSError, EOFError) as x:
+                    if not isinstance(x, EOFError):
+                        print("{0}: {1}".format(path, x), file=sys.stderr)
+                    del clients[conn]
+                    conn.close()
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        for conn in clients:
+            conn.close()
+        server.close()
+        os.remove(path)
+
+class Client(object):
+    """A connection to a daemon started with --serve.
+
+    analyze maps an iterable of file names to FileResults, like the analyze
+    functions of main, sending them to the daemon in batches with the
+    current options. If the daemon goes away, the remaining files are
+    analyzed in this process instead.
+    """
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.f = self.sock.makefile("rwb")
+    def close(self):
+        if self.f is not None:
+            try:
+                self.f.close()
+            except OSError:
+                # unsent data of a request the daemon never got
+                pass
+            self.sock.close()
+            self.f = None
+    def options(self):
+        options = dict((k, globals()[k]) for k in WorkerOptions)
+        # the daemon has a different current directory
+        if CacheDir is not None:
+            options["CacheDir"] = os.path.abspath(CacheDir)
+        options["RuleFiles"] = [os.path.abspath(fn) for fn in RuleFiles]
+        return options
+    def request(self, names):
+        if not names:
+            return []
+        request = {"format": ServeFormat, "options": self.options(), "files": [os.path.abspath(fn) for fn in names]}
+        self.f.write(json.dumps(request).encode("utf-8") + b"\n")
+        self.f.flush()
+        results = []
+        for fn in names:
+            line = self.f.readline()
+            if not line:
+                raise EOFError("the daemon closed the connection")
+            data = json.loads(line)
+            if "error" in data and "name" not in data:
+                raise ValueError(data["error"])
+            results.append(result_from_json(data, fn))
+        return results
+    def analyze(self, names):
+        names = iter(names)
+        while True:
+            batch = list(itertools.islice(names, ServeBatch))
+            if not batch:
+                break
+            results = None
+            if self.f is not None:
+                try:
+                    # the daemon reads files itself, archive members from
+                    # expand_archives are analyzed here
+                    remote = iter(self.request([fn for fn in batch if not isinstance(fn, tuple)]))
+                    results = [check_file(fn) if isinstance(fn, tuple) else next(remote) for fn in batch]
+                except (OSError, EOFError, ValueError) as x:
+                    print("pyqver3: analyzing without the daemon: {0}".format(x), file=sys.stderr)
+                    self.close()
+            if results is None:
+                results = map(check_file, batch)
+            for r in results:
+                yield r
+
+def connect(path):
+    """Return a Client for the daemon listening on the Unix socket path, or
+    None if there is none.
+    """
+    if getattr(socket, "AF_UNIX", None) is None:
+        return None
+    try:
+        return Client(path)
+    except OSError:
+        return None
+
+def _init_worker(options):
+    globals().update(options)
+
+def ordered_imap(pool, func, iterable, depth):
+    """Like pool.imap, but only pulls depth items ahead of the consumer.
+
+    This keeps memory flat when iterable is a long lazy generator, while
+    still returning results in input order.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# the options that can be given in the [tool.pyqver] table of a config
+# file, with the type of their values
+ConfigOptions = {"target-version": str, "include": list, "exclude": list, "allow": list}
+
+def find_config(path):
+    """Return the name of the pyproject.toml in path or the nearest of its
+    parents that has one, or None.
+    """
+    path = os.path.abspath(path)
+    while True:
+        fn = os.path.join(path, "pyproject.toml")
+        if os.path.isfile(fn):
+            return fn
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def load_config(path):
+    """Return the options in the [tool.pyqver] table of the TOML file path,
+    as a dict, with target-version converted to a tuple.
+
+    A file without the table is not parsed at all, so that a pyproject.toml
+    found by find_config costs nothing when it is not for pyqver. Raises
+    ValueError for a malformed file or option and IOError if the file
+    cannot be read.
+    """
+    f = open(path, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if b"tool.pyqver" not in data:
+        return {}
+    try:
+        import tomllib
+    except ImportError:
+        # tomllib is new in Python 3.11
+        try:
+            import tomli as tomllib
+        except ImportError:
+            raise ValueError("{0}: reading it needs Python 3.11 or the tomli package".format(path))
+    try:
+        config = tomllib.loads(data.decode("utf-8")).get("tool", {}).get("pyqver", {})
+    except (tomllib.TOMLDecodeError, UnicodeDecodeError) as x:
+        raise ValueError("{0}: {1}".format(path, x))
+    for key, value in config.items():
+        if key not in ConfigOptions:
+            raise ValueError("{0}: unknown option {1} in [tool.pyqver]".format(path, key))
+        if not isinstance(value, ConfigOptions[key]) or (isinstance(value, list) and not all(isinstance(x, str) for x in value)):
+            raise ValueError("{0}: bad value for {1} in [tool.pyqver]".format(path, key))
+    if "target-version" in config:
+        try:
+            config["target-version"] = parse_version(config["target-version"])
+        except ValueError:
+            raise ValueError("{0}: bad target-version {1!r}".format(path, config["target-version"]))
+    return config
 
 Verbose = False
 MinVersion = (3, 0)
 Lint = False
+Jobs = 1
+Include = ["*.py"]
+Exclude = []
+FilesFrom = []
+CacheDir = None
+RuleFiles = []
+Allow = []
+CacheMaxAge = 30
+CacheMaxSize = 256
+FailAbove = None
+Prefilter = False
+ReportFile = None
+Since = None
+Format = "text"
+CollectStats = False
+Project = False
+Watch = False
+Legacy = False
+Tolerant = False
+MaxSize = None
+Serve = None
+Connect = None
+Shard = None
+Merge = False
+
+# the defaults of the options above, which every call of main starts from
+OptionDefaults = dict((k, globals()[k]) for k in ["Verbose", "MinVersion", "Lint", "Jobs", "Include", "Exclude", "FilesFrom",
+    "CacheDir", "CacheMaxAge", "CacheMaxSize", "FailAbove", "Prefilter", "ReportFile", "Since", "Format", "CollectStats",
+    "Project", "RuleFiles", "Watch", "Legacy", "Tolerant", "MaxSize", "Allow", "Serve", "Connect", "Shard", "Merge"])
+
+# the options check_file depends on, passed on to worker processes
+WorkerOptions = ["Verbose", "Lint", "CacheDir", "RuleFiles", "FailAbove", "Prefilter", "Format", "CollectStats", "Project", "Legacy", "Tolerant", "MaxSize", "Allow", "Shard", "ReportFile"]
+
+def main(argv=None):
+    """Run the command line interface and return the exit status.
+
+    Options given to an earlier call do not carry over to the next one:
+
+    >>> import tempfile
+    >>> cwd = os.getcwd()
+    >>> os.chdir(tempfile.mkdtemp())
+    >>> with open("a.py", "w") as f:
+    ...     f.write("import lzma\\n")
+    12
+    >>> main(["pyqver3.py", "--no-config", "-l", "--fail-above", "3.0", "a.py"])
+    a.py:1: 3.3 lzma
+    1
+    >>> main(["pyqver3.py", "--no-config", "a.py"])  # doctest: +NORMALIZE_WHITESPACE
+    3.3 a.py
+    0
+
+    The whole result of each file is kept with --report, even where
+    --fail-above alone would stop at the first feature above it:
+
+    >>> with open("b.py", "w") as f:
+    ...     f.write("import asyncio\\nimport tomllib\\n")
+    30
+    >>> main(["pyqver3.py", "--no-config", "--report", "r.json", "--fail-above", "3.3", "b.py"])  # doctest: +NORMALIZE_WHITESPACE
+    3.11 b.py
+    3.11 (total)
+    1
+
+    The report keeps the results for files outside the directory run from:
+
+    >>> os.mkdir("sub")
+    >>> os.chdir("sub")
+    >>> with open("c.py", "w") as f:
+    ...     f.write("x = 1\\n")
+    6
+    >>> main(["pyqver3.py", "--no-config", "--report", "../r.json", "c.py"])  # doctest: +NORMALIZE_WHITESPACE
+    3.0 c.py
+    3.11 (total)
+    0
+
+    A cache filled with --fail-above keeps the whole result for -l:
 
-files = []
-i = 1
-while i < len(sys.argv):
-    a = sys.argv[i]
-    if a == "--test":
-        import doctest
-        doctest.testmod()
-        sys.exit(0)
-    if a == "-v" or a == "--verbose":
-        Verbose = True
-    elif a == "-l" or a == "--lint":
-        Lint = True
-    elif a == "-m" or a == "--min-version":
+    >>> stderr, sys.stderr = sys.stderr, sys.stdout
+    >>> main(["pyqver3.py", "--no-config", "--cache", "cc", "--fail-above", "3.5", "../a.py"])  # doctest: +NORMALIZE_WHITESPACE
+    3.3 ../a.py
+    cache: 0 hits, 1 misses
+    0
+    >>> main(["pyqver3.py", "--no-config", "--cache", "cc", "-l", "../a.py"])
+    ../a.py:1: 3.3 lzma
+    cache: 0 hits, 1 misses
+    0
+    >>> sys.stderr = stderr
+    >>> os.chdir(cwd)
+    """
+    global Verbose, MinVersion, Lint, Jobs, Include, Exclude, FilesFrom
+    global CacheDir, CacheMaxAge, CacheMaxSize, FailAbove, Prefilter
+    global ReportFile, Since, Format, CollectStats, Project, RuleFiles, Watch
+    global Legacy, Tolerant, MaxSize, Allow, Serve, Connect, Shard, Merge
+    for k, v in OptionDefaults.items():
+        globals()[k] = list(v) if isinstance(v, list) else v
+    if argv is None:
+        argv = sys.argv
+    include = []
+    exclude = []
+    files_from = []
+    rule_files = []
+    min_version = None
+    config_file = None
+    files = []
+    i = 1
+    while i < len(argv):
+        a = argv[i]
+        if a == "--test":
+            import doctest
+            doctest.testmod()
+            return 0
+        if a == "-v" or a == "--verbose":
+            Verbose = True
+        elif a == "-l" or a == "--lint":
+            Lint = True
+        elif a == "-m" or a == "--min-version":
+            i += 1
+            min_version = tuple(map(int, argv[i].split(".")))
+        elif a == "-j" or a == "--jobs":
+            i += 1
+            Jobs = int(argv[i])
+        elif a == "--include":
+            i += 1
+            include.append(argv[i])
+        elif a == "--exclude":
+            i += 1
+            exclude.append(argv[i])
+        elif a == "--files-from":
+            i += 1
+            files_from.append(argv[i])
+        elif a == "--cache":
+            i += 1
+            CacheDir = argv[i]
+        elif a == "--cache-max-age":
+            i += 1
+            CacheMaxAge = float(argv[i])
+        elif a == "--cache-max-size":
+            i += 1
+            CacheMaxSize = float(argv[i])
+        elif a == "--fail-above":
+            i += 1
+            FailAbove = tuple(map(int, argv[i].split(".")))
+        elif a == "--prefilter":
+            Prefilter = True
+        elif a == "--report":
+            i += 1
+            ReportFile = argv[i]
+        elif a == "--since":
+            i += 1
+            Since = argv[i]
+        elif a == "--format":
+            i += 1
+            Format = argv[i]
+        elif a == "--stats":
+            CollectStats = True
+        elif a == "--project":
+            Project = True
+        elif a == "--max-size":
+            i += 1
+            MaxSize = int(float(argv[i]) * 1024)
+        elif a == "--legacy":
+            Legacy = True
+        elif a == "--tolerant":
+            Tolerant = True
+        elif a == "--watch":
+            Watch = True
+        elif a == "--rules":
+            i += 1
+            rule_files.append(argv[i])
+        elif a == "--config":
+            i += 1
+            config_file = argv[i]
+        elif a == "--no-config":
+            config_file = False
+        elif a == "--serve":
+            i += 1
+            Serve = argv[i]
+        elif a == "--connect":
+            i += 1
+            Connect = argv[i]
+        elif a == "--shard":
+            i += 1
+            Shard = tuple(map(int, argv[i].split("/")))
+        elif a == "--merge":
+            Merge = True
+        else:
+            files.append(a)
         i += 1
-        MinVersion = tuple(map(int, sys.argv[i].split(".")))
-    else:
-        files.append(a)
-    i += 1
 
-if not files:
-    print("""Usage: {0} [options] source ...
+    if Format not in ("text", "jsonl", "sarif"):
+        print("{0}: unknown format {1}".format(argv[0], Format), file=sys.stderr)
+        return 1
+    if Watch and (files_from or Since is not None or ReportFile is not None or Project or Format == "sarif"):
+        print("{0}: --watch cannot be used with --files-from, --since, --report, --project or --format sarif".format(argv[0]), file=sys.stderr)
+        return 1
+    if Shard is not None and (len(Shard) != 2 or not 1 <= Shard[0] <= Shard[1]):
+        print("{0}: --shard must be i/n with i from 1 to n".format(argv[0]), file=sys.stderr)
+        return 1
+    if Shard is not None and (Merge or ReportFile is not None or Project or Watch or Serve is not None):
+        print("{0}: --shard cannot be used with --merge, --report, --project, --watch or --serve".format(argv[0]), file=sys.stderr)
+        return 1
+    if Merge and (files_from or Since is not None or Project or Watch or Serve is not None or CollectStats):
+        print("{0}: --merge cannot be used with --files-from, --since, --project, --watch, --serve or --stats".format(argv[0]), file=sys.stderr)
+        return 1
+    if not files and not files_from and Since is None and Serve is None:
+        print("""Usage: {0} [options] source ...
 
     Report minimum Python version required to run given source files.
+    Directories are searched recursively for files matching --include.
+    Wheels, zip and tar archives are searched the same way without
+    extracting them, and members are reported as archive!member.
 
-    -m x.y or --min-version x.y (default 3.0)
+    --cache dir
+        reuse results for unchanged files from the cache in dir
+    --cache-max-age days (default 30)
+        remove cache entries unused for this many days
+    --cache-max-size mb (default 256)
+        remove least recently used cache entries beyond this size
+    --connect socket
+        have the daemon listening on socket analyze the files, if it is
+        running, instead of analyzing them in this process (not with
+        --stats)
+    --config file
+        read options from the [tool.pyqver] table of file instead of the
+        pyproject.toml in the current directory or its nearest parent
+    --exclude pattern
+        skip files and directories matching pattern (may be repeated)
+    --fail-above x.y
+        exit with status 1 if any file requires a version above x.y; the
+        version shown for such a file may be only the first one found
+        above x.y
+    --files-from file
+        also read source paths from file, one per line ("-" for stdin)
+    --format text|jsonl|sarif
+        print the text report (default), a JSON record per file, or a SARIF
+        log of the findings; -l and -v only apply to the text report
+    --include pattern
+        analyze files in directories matching pattern (default *.py,
+        may be repeated)
+    -j n or --jobs n
+        analyze files using n worker processes (0 means one per CPU)
+    --legacy
+        also check the features added in Python 2, as pyqver2.py does,
+        counting versions from 2.0
+    -l or --lint
+        print a lint style report showing each offending line
+    --max-size kb
+        skip files larger than kb kilobytes; binary files are always skipped
+    --merge
+        read the sources as the partial reports of every --shard of a run,
+        and report on them as that run would have without --shard
+    -m x.y or --min-version x.y (default 3.0, or 2.3 with --legacy)
         report version triggers at or above version x.y in verbose mode
+    --no-config
+        do not read options from pyproject.toml
+    --prefilter
+        report files with no candidate names or keywords as 3.0 without
+        parsing them (syntax errors in such files are not reported)
+    --project
+        include the versions needed by local modules each file imports,
+        found relative to the directories given and those of the files
+    --report file
+        keep per-file results in file between runs, and print the maximum
+        version over all files in it
+    --rules file
+        add the rules in file to the built in rules, overriding them (may
+        be repeated)
+    --serve socket
+        run as a daemon answering requests from --connect on the Unix
+        socket, keeping rules and results in memory, until interrupted
+    --shard i/n
+        only analyze the i-th of n parts of the files, balanced by size,
+        and print a partial report of them for --merge instead
+    --since rev
+        only analyze files changed since the git revision rev, or in the
+        range rev if it contains ".."; given sources limit the search
+    --stats
+        print time spent per stage, the slowest files, nodes visited per
+        node type and hits per rule on stderr
+    --tolerant
+        look for imports, calls and (with --legacy) other features in the
+        tokens of files that do not parse, such as Python 2 code with print
+        statements, instead of reporting a syntax error
     -v or --verbose
-        print more detailed report of version triggers for each version
-""".format(sys.argv[0]), file=sys.stderr)
-    sys.exit(1)
+        print more detailed report of version triggers for each version,
+        and the version each top-level function and class with triggers
+        needs
+    --watch
+        after the report, keep analyzing files as they change and print
+        them again when their version changes, until interrupted
+""".format(argv[0]), file=sys.stderr)
+        return 1
+
+    config = {}
+    if config_file is not False:
+        path = config_file or find_config(os.getcwd())
+        try:
+            if path is not None:
+                config = load_config(path)
+        except (IOError, OSError, ValueError) as x:
+            print("{0}: could not load config: {1}".format(argv[0], x), file=sys.stderr)
+            return 1
+    target = config.get("target-version")
+
+    Include = include or config.get("include") or ["*.py"]
+    # config patterns with a directory part are relative to the config file
+    config_dir = os.path.dirname(os.path.abspath(path)) if config else None
+    Exclude = [os.path.normpath(os.path.join(config_dir, x) if "/" in x or os.sep in x else x) for x in config.get("exclude", [])]
+    Exclude += [os.path.normpath(x) for x in exclude]
+    FilesFrom = files_from
+    RuleFiles = rule_files
+    Allow = config.get("allow", [])
+    if target is not None:
+        # the target version is known to be fine, only the findings above
+        # it matter
+        if FailAbove is None:
+            FailAbove = target
+        if min_version is None:
+            min_version = target[:-1] + (target[-1] + 1,)
+    MinVersion = min_version or ((2, 3) if Legacy else (3, 0))
+    set_rules(None, Legacy)
+    if Serve is not None:
+        try:
+            return serve(Serve)
+        except (IOError, OSError, ValueError) as x:
+            print("{0}: could not serve on {1}: {2}".format(argv[0], Serve, x), file=sys.stderr)
+            return 1
+
+    client = None
+    if Connect is not None and not CollectStats and not Merge:
+        client = connect(Connect)
+    if client is None:
+        # the daemon loads the rules itself
+        try:
+            get_rules(Legacy)
+        except (IOError, ValueError) as x:
+            print("{0}: could not load rules: {1}".format(argv[0], x), file=sys.stderr)
+            return 1
+
+    sources = files
+    if Since is not None:
+        try:
+            files = git_changed_files(Since, files)
+        except (OSError, subprocess.CalledProcessError) as x:
+            print("{0}: could not list files changed since {1}: {2}".format(argv[0], Since, x), file=sys.stderr)
+            return 1
+
+    stored = None
+    if ReportFile is not None:
+        # the partial reports have the results for every file
+        stored = {} if Merge else load_report(ReportFile)
+        base = os.path.dirname(os.path.realpath(ReportFile))
+        cwd = os.path.realpath(os.getcwd())
+        # only files under what was scanned can be known to be gone; git
+        # lists the changes under the current directory by default
+        roots = [report_key(fn, base, cwd) for fn in (sources or (["."] if Since is not None else []))]
+
+    if Merge:
+        pool = None
+        analyze = None
+    elif client is not None:
+        pool = None
+        analyze = client.analyze
+    elif Jobs != 1:
+        import multiprocessing
+        options = dict((k, globals()[k]) for k in WorkerOptions)
+        pool = multiprocessing.Pool(Jobs or None, _init_worker, (options,))
+        # results come back in input order, so the report is the same as for
+        # a serial run
+        analyze = lambda names: ordered_imap(pool, check_file, names, 16 * (Jobs or os.cpu_count() or 1))
+    else:
+        pool = None
+        analyze = lambda names: map(check_file, names)
+    if Watch:
+        try:
+            return watch(files, analyze)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if client is not None:
+                client.close()
+    if Project:
+        import_roots = []
+        for fn in files:
+            root = os.path.normpath(fn if os.path.isdir(fn) else os.path.dirname(fn))
+            if root not in import_roots:
+                import_roots.append(root)
+        results = project_results(files, analyze, import_roots)
+    elif Merge:
+        try:
+            results = merge_partials(files)
+        except (IOError, OSError, ValueError) as x:
+            print("{0}: could not merge partial reports: {1}".format(argv[0], x), file=sys.stderr)
+            return 1
+    elif Shard is not None:
+        names = list(iter_files(files))
+        # the options that decide which files are found and what is found in
+        # them have to be the same for every shard
+        options = {"rules": rules_fingerprint(), "sources": sources, "since": Since, "include": Include, "exclude": Exclude,
+            "max_size": MaxSize, "prefilter": Prefilter, "tolerant": Tolerant}
+        assigned, digest = shard_files(names, Shard[0], Shard[1])
+        partial = PartialReport({"format": ShardFormat, "shard": Shard[0], "shards": Shard[1], "files": len(names), "digest": digest,
+            "options": options})
+        order = collections.deque()
+        empty = []
+        results = analyze(shard_members(assigned, order, empty))
+    else:
+        results = analyze(expand_archives(iter_files(files)))
+
+    sarif = None
+    if Format == "sarif" and Shard is None:
+        sarif = SarifReport()
 
-for fn in files:
+    stats = None
+    if CollectStats:
+        stats = Stats()
+
+    status = 0
+    counts = collections.Counter()
+    # the archive the latest results are members of, and the highest
+    # version among them; members of an archive come one after another
+    archive = None
+    archive_ver = None
+    # the members found in each archive, to forget the rest in the report
+    members = {}
     try:
-        f = open(fn)
-        source = f.read()
-        f.close()
-        ver = get_versions(source, fn)
-        if Verbose:
-            print(fn)
-            for v in sorted([k for k in ver.keys() if k >= MinVersion], reverse=True):
-                reasons = [x for x in uniq(ver[v]) if x]
-                if reasons:
-                    # each reason is (lineno, message)
-                    print("\t{0}\t{1}".format(".".join(map(str, v)), ", ".join(x[1] for x in reasons)))
-        elif Lint:
-            for v in sorted([k for k in ver.keys() if k >= MinVersion], reverse=True):
-                reasons = [x for x in uniq(ver[v]) if x]
-                for r in reasons:
-                    # each reason is (lineno, message)
-                    print("{0}:{1}: {2} {3}".format(fn, r[0], ".".join(map(str, v)), r[1]))
-        else:
-            print("{0}\t{1}".format(".".join(map(str, max(ver.keys()))), fn))
-    except SyntaxError as x:
-        print("{0}: syntax error compiling with Python {1}: {2}".format(fn, platform.python_version(), x))
+        for r in results:
+            fn, ver, err = r.filename, r.versions, r.error
+            counts[r.how] += 1
+            if stats is not None:
+                stats.merge(r.stats)
+                stats.file_done(fn, r.seconds)
+            if Shard is not None:
+                partial.result(order.popleft(), r)
+                continue
+            if archive_of(fn) != archive:
+                if archive_ver is not None:
+                    report_archive(archive, archive_ver)
+                archive = archive_of(fn)
+                archive_ver = None
+            if archive is not None:
+                if err is None and (archive_ver is None or max(ver) > archive_ver):
+                    archive_ver = max(ver)
+                if stored is not None:
+                    members.setdefault(report_key(archive, base, cwd), set()).add(report_key(fn, base, cwd))
+            with stage(stats, "report"):
+                if Format == "jsonl":
+                    report_jsonl(fn, ver, err, r.seconds)
+                elif sarif is not None:
+                    sarif.report(fn, ver, err, r.seconds)
+                elif err is not None:
+                    print("{0}: {1}".format(fn, err))
+                else:
+                    report(fn, ver, r.scopes)
+            if err is not None:
+                if stored is not None:
+                    stored.pop(report_key(fn, base, cwd), None)
+            else:
+                if FailAbove is not None and max(ver) > FailAbove:
+                    status = 1
+                if stored is not None:
+                    stored[report_key(fn, base, cwd)] = pack_versions(ver)
+    except MergeError as x:
+        # found only once the results before it have been reported
+        print("{0}: could not merge partial reports: {1}".format(argv[0], x), file=sys.stderr)
+        return 1
+    if archive_ver is not None:
+        report_archive(archive, archive_ver)
+    if Shard is not None:
+        partial.finish(empty)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if client is not None:
+        client.close()
+
+    if stored is not None and not Merge:
+        for key in list(stored):
+            path = archive_of(key)
+            if path in members and key not in members[path]:
+                del stored[key]
+            elif report_covers(key, roots) and not os.path.exists(os.path.join(base, path or key)):
+                del stored[key]
+    if stored is not None:
+        save_report(ReportFile, stored)
+        if stored:
+            total = max(max(ver) for ver in stored.values())
+            if Format == "jsonl":
+                print(json.dumps({"total": format_version(total)}))
+            elif Format == "text":
+                print("{0}\t(total)".format(format_version(total)))
+            if FailAbove is not None and total > FailAbove:
+                status = 1
+
+    if sarif is not None:
+        sarif.finish()
+
+    if CacheDir is not None:
+        print("cache: {0} hits, {1} misses".format(counts["cache"], counts["parse"]), file=sys.stderr)
+        cache_evict(CacheMaxAge * 86400, CacheMaxSize * 1024 * 1024)
+    if stats is not None:
+        stats.print(sys.stderr)
+    if Prefilter:
+        print("prefilter: {0} of {1} files resolved without parsing".format(counts["prefilter"], sum(counts.values())), file=sys.stderr)
+
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())